@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import json
+import math
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import pandas as pd
+
+from core import (
+    YOM_YEARS, DUTY_COMPONENTS, DEFAULT_EX_RATE, LANDED_FEES, find_catalogue_files, load_catalogue,
+    calculate_duty_frame, build_duty_cube, build_search_index, search_catalogue, build_quote_keys,
+    quote_manifest, landed_cost,
+)
+
+# Local JSON quoting service over the same core as app.py:
+#   python api.py --port 8000
+#   GET  /lookup?code=...            GET /search?q=prado&yom=2020&limit=20
+#   GET  /duty?code=...&yom=2020     GET /landed?make=TOYOTA&model=HARRIER&yom=2020&cnf_usd=9000
+#   POST /quote  [{"code": "...", "yom": 2020, "cnf_usd": 9000}, ...]
+
+QUOTE_CACHE_SIZE = 65536
+MAX_SEARCH_LIMIT = 1000
+MAX_BODY_BYTES = 32 * 1024 * 1024
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Loaded once at startup and only read afterwards, so every request shares the same arrays
+catalogue = None
+quote_keys = None
+duty_cube = None
+search_index = None
+
+TOTAL = DUTY_COMPONENTS.index('Total')
+
+def load(catalogue_paths, skip_errors=False):
+    global catalogue, quote_keys, duty_cube, search_index
+    catalogue = load_catalogue(catalogue_paths, skip_errors)
+    quote_keys = build_quote_keys(catalogue)
+    duty_cube = build_duty_cube(catalogue, YOM_YEARS)
+    search_index = build_search_index(catalogue, duty_cube['values'][0, :, TOTAL])
+    price_duty.cache_clear()
+
+def to_json(value):
+    if isinstance(value, np.generic): return value.item()
+    raise TypeError(f"not JSON serialisable: {type(value).__name__}")
+
+def vehicle_records(positions):
+    rows = catalogue.iloc[positions].astype(object)
+    return rows.where(rows.notna(), None).to_dict(orient='records')
+
+def vehicle_record(pos):
+    return vehicle_records([pos])[0]
+
+def resolve_vehicle(params):
+    code = (params.get('code') or '').upper().strip()
+    if code and 'code' in quote_keys and code in quote_keys['code'].index: return int(quote_keys['code'][code])
+    name = params.get('name') or f"{params.get('make', '')} {params.get('model', '')}"
+    name = name.upper().strip()
+    if name in quote_keys['name'].index: return int(quote_keys['name'][name])
+    raise ApiError(404, "vehicle not found")
+
+def param_number(params, key, kind, default=None):
+    value = params.get(key, default)
+    if value is None: raise ApiError(400, f"missing parameter: {key}")
+    try: number = kind(value)
+    except (TypeError, ValueError): raise ApiError(400, f"invalid {key}: {value!r}")
+    # float() accepts "nan" and "inf", which would come back out as invalid JSON
+    if not math.isfinite(number): raise ApiError(400, f"invalid {key}: {value!r}")
+    return number
+
+@lru_cache(maxsize=QUOTE_CACHE_SIZE)
+def price_duty(pos, yom):
+    # Years outside the duty cube (older stock, next year's models) are priced per vehicle and memoised
+    tax = calculate_duty_frame(catalogue.iloc[[pos]], yom).iloc[0]
+    return {k: (v.item() if isinstance(v, np.generic) else v) for k, v in tax.items()}
+
+def quote_duty(pos, yom):
+    if yom not in duty_cube['years']: return price_duty(pos, yom)
+    j = duty_cube['years'][yom]
+    return {**dict(zip(DUTY_COMPONENTS, duty_cube['values'][j, pos].tolist())),
+            "Depreciation": float(duty_cube['depreciation'][j]), "Class": duty_cube['class'][pos]}
+
+def duty_totals(positions, yom):
+    # One cube slice for every hit; other years price all the hits in a single pass
+    if yom in duty_cube['years']: return duty_cube['values'][duty_cube['years'][yom], positions, TOTAL]
+    return calculate_duty_frame(catalogue.iloc[positions], yom)['Total'].to_numpy()
+
+def handle_lookup(params):
+    return vehicle_record(resolve_vehicle(params))
+
+def handle_search(params):
+    yom = param_number(params, 'yom', int, YOM_YEARS[0])
+    limit = param_number(params, 'limit', int, 20)
+    if not 0 <= limit <= MAX_SEARCH_LIMIT: raise ApiError(400, f"limit must be between 0 and {MAX_SEARCH_LIMIT}")
+    hits = search_catalogue(search_index, params.get('q', ''))
+    shown = hits[:limit]
+    return {
+        "found": len(hits),
+        "results": [{**record, "Duty": duty} for record, duty in zip(vehicle_records(shown), duty_totals(shown, yom).tolist())],
+    }
+
+def handle_duty(params):
+    pos = resolve_vehicle(params)
+    yom = param_number(params, 'yom', int)
+    return {"vehicle": vehicle_record(pos), "yom": yom, "duty": quote_duty(pos, yom)}
+
+def handle_landed(params):
+    pos = resolve_vehicle(params)
+    yom = param_number(params, 'yom', int)
+    cnf_usd = param_number(params, 'cnf_usd', float)
+    ex_rate = param_number(params, 'ex_rate', float, DEFAULT_EX_RATE)
+    duty = quote_duty(pos, yom)
+    return {
+        "vehicle": vehicle_record(pos), "yom": yom, "duty": duty,
+        "cnf_kes": cnf_usd * ex_rate, "fees": LANDED_FEES,
+        "landed_cost": float(landed_cost(cnf_usd, ex_rate, duty['Total'])),
+    }
+
+def handle_quote(body, params):
+    # Batched: the whole list goes through the vectorised manifest pricer in one pass
+    if not isinstance(body, list) or not all(isinstance(item, dict) for item in body):
+        raise ApiError(400, "expected a JSON list of vehicle objects")
+    ex_rate = param_number(params, 'ex_rate', float, DEFAULT_EX_RATE)
+    manifest = pd.DataFrame([{
+        "Make": item.get('make'), "Model": item.get('model'), "Model_Code": item.get('code'),
+        "YOM": item.get('yom'), "CNF_USD": item.get('cnf_usd'),
+    } for item in body], columns=["Make", "Model", "Model_Code", "YOM", "CNF_USD"])
+    quoted = quote_manifest(catalogue, quote_keys, manifest, ex_rate)
+    return quoted.astype(object).where(quoted.notna(), None).to_dict(orient='records')
+
+GET_ROUTES = {"/lookup": handle_lookup, "/search": handle_search, "/duty": handle_duty, "/landed": handle_landed}
+
+def reject_constant(name):
+    raise ValueError(f"{name} is not valid JSON")
+
+async def dispatch(method, path, params, body):
+    if path == "/health": return {"status": "ok", "vehicles": len(catalogue)}
+    if path in GET_ROUTES:
+        if method != "GET": raise ApiError(405, "use GET")
+        # Off the event loop, so a large search never holds up /health or other connections
+        return await asyncio.get_running_loop().run_in_executor(None, GET_ROUTES[path], params)
+    if path == "/quote":
+        if method != "POST": raise ApiError(405, "use POST")
+        # NaN / Infinity are not JSON; accepting them would let them flow back out in the reply
+        try: payload = json.loads(body or b'null', parse_constant=reject_constant)
+        except ValueError: raise ApiError(400, "invalid JSON body")
+        return await asyncio.get_running_loop().run_in_executor(None, handle_quote, payload, params)
+    raise ApiError(404, "unknown endpoint")
+
+def content_length(headers):
+    try: length = int(headers.get('content-length') or 0)
+    except ValueError: length = -1
+    if length < 0: raise ApiError(400, "invalid Content-Length")
+    return length
+
+async def handle_connection(reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line: break
+            try: method, target, version = request_line.decode('latin-1').split()
+            except ValueError: break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''): break
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = None
+            try:
+                length = content_length(headers)
+                if length > MAX_BODY_BYTES: raise ApiError(413, "request body too large")
+                body = await reader.readexactly(length) if length else b''
+                status, payload = 200, await dispatch(method, url.path, params, body)
+            except ApiError as e:
+                status, payload = e.status, {"error": str(e)}
+            except Exception as e:
+                status, payload = 500, {"error": str(e)}
+
+            data = json.dumps(payload, default=to_json).encode('utf-8')
+            # An unread or oversized body leaves the stream out of step, so those replies close the connection
+            keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                          and length is not None and status != 413)
+            writer.write(
+                f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+            )
+            await writer.drain()
+            if not keep_alive: break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_connection, host, port)
+    print(f"Serving {len(catalogue):,} vehicles on http://{host}:{port}")
+    async with server: await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local JSON API for CRSP duty quotes.")
+    parser.add_argument("--catalogue", action="append", help="CRSP catalogue file; repeat to merge several (default: every .xlsx/.csv in the working directory)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    catalogue_paths = args.catalogue or find_catalogue_files()
+    if not catalogue_paths: parser.error("no catalogue file found")
+    load(catalogue_paths, skip_errors=not args.catalogue)
+    asyncio.run(serve(args.host, args.port))
+
+if __name__ == "__main__":
+    main()
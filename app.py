@@ -1,7 +1,21 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from io import BytesIO
 import os
+import time
+from urllib.parse import quote
+
+from perf import start_trace, current_trace, cache_misses, span, finish_trace
+from core import (
+    YOM_YEARS, DUTY_COMPONENTS, FACETS, EXPORT_FORMATS, LANDED_FEES, DEFAULT_EX_RATE, RULE_SETS, DEFAULT_RULE_SET,
+    new_catalogue_store, refresh_catalogue_store, snapshot_index, calculate_duty_frame, duty_for_year,
+    compile_rule_sets, build_regime_cube, patch_regime_cube, regime_deltas, facet_mask, unpack_mask,
+    ROLLUP_DIMENSIONS, build_market_rollups, materialise_rollups, rollup_stats, duty_histogram,
+    build_search_index, patch_search_index, search_catalogue, build_facet_index, patch_facet_index, facet_counts, market_positions,
+    iter_export_chunks, write_export, landed_cost, landed_cost_grid, build_affordability_index, affordable_vehicles,
+    build_vehicle_index, patch_vehicle_index, resolve_vehicle_key,
+)
 
 # ==========================================
 # 1. SETUP & CSS
@@ -116,125 +130,364 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # ==========================================
-# 2. DATA LOADER
+# 2. CACHED CATALOGUE
 # ==========================================
-@st.cache_data
-def load_data():
-    try:
-        files = [f for f in os.listdir('.') if f.endswith(('.xlsx', '.csv')) and 'app.py' not in f]
-        if not files: return pd.DataFrame(), "No file found"
-        
-        target = max(files, key=os.path.getsize)
-        
-        if target.endswith('.csv'): df = pd.read_csv(target)
-        else: df = pd.read_excel(target)
-
-        df.columns = [str(c).strip().replace('\n', ' ') for c in df.columns]
-        
-        rename_map = {}
-        for col in df.columns:
-            c_lower = col.lower()
-            if 'capacity' in c_lower and 'cc' not in rename_map.values(): rename_map[col] = 'CC'
-            elif 'body' in c_lower: rename_map[col] = 'Category'
-            elif 'crsp' in c_lower: rename_map[col] = 'CRSP'
-            elif 'drive' in c_lower: rename_map[col] = 'Drive'
-            elif 'seat' in c_lower: rename_map[col] = 'Seating'
-            elif 'fuel' in c_lower: rename_map[col] = 'Fuel'
-            elif 'trans' in c_lower: rename_map[col] = 'Transmission'
-            elif 'model' in c_lower and 'number' in c_lower: rename_map[col] = 'Model_Code'
-            
-        df = df.rename(columns=rename_map)
-
-        df['CRSP'] = pd.to_numeric(df['CRSP'], errors='coerce').fillna(0)
-        df = df[df['CRSP'] > 0] # Filter invalid prices
-        
-        def clean_cc(x):
-            try: return int(''.join(filter(str.isdigit, str(x))))
-            except: return 0
-        
-        if 'CC' in df.columns: df['CC'] = df['CC'].apply(clean_cc)
-        else: df['CC'] = 0
-
-        for c in ['Make', 'Model', 'Fuel', 'Transmission', 'Drive', 'Category', 'Seating']:
-            if c not in df.columns:
-                df[c] = "-" 
-            else:
-                df[c] = df[c].astype(str).str.upper().str.strip().replace(['NAN', 'NONE'], '-')
-
-        df['Search_Name'] = df['Make'] + " " + df['Model']
-        return df, None
-    except Exception as e:
-        return pd.DataFrame(), str(e)
+EXPORT_CACHE_ENTRIES = 16
+SCENARIO_ROWS = 200 # biggest movers listed per regime comparison
+SEARCH_PAGE_SIZE = 60
+CARD_CACHE_ENTRIES = 4096 # rendered cards / breakdowns kept across sessions, least recently used evicted first
+ROLLUP_CHART_GROUPS = 15 # largest groups drawn in the rollup chart; the table lists them all
+
+# Plain Vega-Lite specs: building and validating the Altair equivalents costs more than the data they draw
+ROLLUP_GROUP_SPEC = {
+    "encoding": {
+        "y": {"field": "Group", "type": "nominal", "sort": "-x", "title": None},
+        "tooltip": [{"field": "Group"}, {"field": "Vehicles"},
+                    {"field": "Median", "type": "quantitative", "format": ",.0f"},
+                    {"field": "P90", "type": "quantitative", "format": ",.0f"}],
+    },
+    "layer": [
+        {"mark": {"type": "bar", "color": "#4facfe"},
+         "encoding": {"x": {"field": "Median", "type": "quantitative", "title": "Duty (KES): median, with P90 tick"}}},
+        {"mark": {"type": "tick", "color": "white", "thickness": 2},
+         "encoding": {"x": {"field": "P90", "type": "quantitative"}}},
+    ],
+}
+ROLLUP_HISTOGRAM_SPEC = {
+    "mark": {"type": "bar", "color": "#4facfe"},
+    "encoding": {
+        "x": {"field": "From", "type": "quantitative", "scale": {"type": "log"}, "title": "Duty (KES)"},
+        "x2": {"field": "To"},
+        "y": {"field": "Vehicles", "type": "quantitative"},
+        "tooltip": [{"field": "From", "type": "quantitative", "format": ",.0f"},
+                    {"field": "To", "type": "quantitative", "format": ",.0f"}, {"field": "Vehicles"}],
+    },
+}
+SENSITIVITY_SPEC = {
+    "mark": "rect",
+    "encoding": {
+        "x": {"field": "KES/$", "type": "ordinal"},
+        "y": {"field": "CNF (USD)", "type": "ordinal", "sort": "descending"},
+        "color": {"field": "Landed Cost", "type": "quantitative", "scale": {"scheme": "blues"}},
+        "tooltip": [{"field": "CNF (USD)"}, {"field": "KES/$"},
+                    {"field": "Landed Cost", "type": "quantitative", "format": ",.0f"}],
+    },
+}
+INDEX_CACHE_VERSIONS = 2 # current catalogue version plus the one sessions may still be finishing a rerun on
+RULE_REGIMES = compile_rule_sets(RULE_SETS)
+
+# Cached bodies only run on a miss, so they record themselves on the calling thread's trace for the perf spans
+@st.cache_resource
+def catalogue_store():
+    # One refreshable store shared by every session; snapshots are replaced, never mutated
+    cache_misses().add('load_data')
+    return new_catalogue_store()
+
+def load_snapshot():
+    # Each rerun pins one snapshot so the catalogue, cube and indexes it reads always agree
+    store = catalogue_store()
+    changes = refresh_catalogue_store(store)
+    if changes is not None: cache_misses().add('load_data')
+    return store['snapshot'], changes
+
+def load_duty_cube(snap):
+    # Patched in place of a rebuild by the refresh, so it lives on the snapshot itself
+    return snap['cube']
+
+def load_index(snap, name, build, patch=None):
+    # Indexes live on the snapshot too: built on first use, or patched from the previous snapshot's copy
+    # after a catalogue refresh, so only the rows that changed are worked on
+    if name not in snap['indexes']: cache_misses().add(name)
+    return snapshot_index(snap, name, build, patch)
+
+def snapshot_total(snap):
+    return snap['cube']['values'][0, :, DUTY_COMPONENTS.index('Total')]
+
+def load_search_index(snap):
+    if load_duty_cube(snap) is None: return None
+    return load_index(snap, 'load_search_index',
+                      lambda s: build_search_index(s['df'], snapshot_total(s)),
+                      lambda old, s: patch_search_index(old, s['df'], snapshot_total(s), s['reuse']))
+
+def load_facet_index(snap):
+    if snap['error'] or snap['df'].empty: return None
+    return load_index(snap, 'load_facet_index', lambda s: build_facet_index(s['df']),
+                      lambda old, s: patch_facet_index(old, s['df'], s['reuse']))
+
+def load_vehicle_index(snap):
+    if snap['error'] or snap['df'].empty: return None
+    return load_index(snap, 'load_vehicle_index', lambda s: build_vehicle_index(s['df']),
+                      lambda old, s: patch_vehicle_index(old, s['df'], s['reuse']))
+
+def load_affordability_index(snap):
+    # Gathers of the patched cube in the new duty order; nothing per row to carry over
+    search_index = load_search_index(snap)
+    if search_index is None: return None
+    return load_index(snap, 'load_affordability_index', lambda s: build_affordability_index(load_duty_cube(s), search_index['order']))
+
+def load_market_rollups(snap):
+    search_index = load_search_index(snap)
+    if search_index is None: return None
+    return load_index(snap, 'load_market_rollups', lambda s: build_market_rollups(s['df'], search_index['order']))
+
+def load_regime_cube(snap):
+    # Every rule set in one pass, so changing the baseline or the compared regimes is only a slice
+    if snap['error'] or snap['df'].empty: return None
+    return load_index(snap, 'load_regime_cube', lambda s: build_regime_cube(s['df'], YOM_YEARS, RULE_REGIMES),
+                      lambda old, s: patch_regime_cube(old, s['df'], s['reuse'], YOM_YEARS, RULE_REGIMES))
+
+@st.cache_resource(max_entries=INDEX_CACHE_VERSIONS * len(YOM_YEARS))
+def load_rollup_year(version, yom, _snap):
+    # Materialised per catalogue x YOM; filtered views are answered from the grouped rows instead
+    cache_misses().add('load_rollup_year')
+    rollups = load_market_rollups(_snap)
+    cube = load_duty_cube(_snap)
+    if rollups is None: return None
+    return materialise_rollups(rollups, cube['values'][cube['years'][yom], :, DUTY_COMPONENTS.index('Total')])
+
+@st.cache_data(max_entries=EXPORT_CACHE_ENTRIES, show_spinner=False)
+def build_market_export(fmt, yom, selections, version, _snap):
+    # Memoised per (format, YOM, filter signature, catalogue version); only runs when a download is requested
+    cache_misses().add('build_market_export')
+    cube = load_duty_cube(_snap)
+    facet_index = load_facet_index(_snap)
+    search_index = load_search_index(_snap)
+    duty = cube['values'][cube['years'][yom], :, DUTY_COMPONENTS.index('Total')]
+    positions = market_positions(facet_index, search_index['order'], dict(selections))
+    out = BytesIO()
+    write_export(iter_export_chunks(_snap['df'], duty, positions), fmt, out)
+    return out.getvalue()
+
+def export_report(fmt, yom, selections, snap):
+    # Runs on the download thread, outside the page rerun, so it logs its own trace
+    start_trace("export", fmt=fmt, yom=yom)
+    with span("export", fmt=fmt) as s:
+        data = build_market_export(fmt, yom, selections, snap['version'], snap)
+        s['bytes'] = len(data)
+        s['cache'] = cache_status('build_market_export')
+    finish_trace()
+    return data
+
+@st.cache_resource(max_entries=CARD_CACHE_ENTRIES)
+def search_card_html(version, pos, yom, _snap):
+    # Memoised per (catalogue version, vehicle, YOM) and shared by every session; the LRU bound keeps it small
+    cache_misses().add('search_card_html')
+    row = _snap['df'].iloc[pos]
+    cube = load_duty_cube(_snap)
+    duty_fmt = f"{cube['values'][cube['years'][yom], pos, DUTY_COMPONENTS.index('Total')]:,.0f}"
+    cc_display = f"{row['CC']} CC" if row['CC'] > 0 else "⚡ EV"
+    return f"""
+    <div class="unit-card">
+        <div class="car-title" title="{row['Search_Name']}">{row['Search_Name']}</div>
+        <div style="font-size:0.7rem; color:#666; text-align:center;">ESTIMATED DUTY</div>
+        <div class="duty-price">KES {duty_fmt}</div>
+        <div class="spec-grid">
+            <div class="spec-item">{cc_display}</div>
+            <div class="spec-item">{row['Fuel']}</div>
+            <div class="spec-item">{row['Transmission']}</div>
+            <div class="spec-item">{row['Drive']}</div>
+        </div>
+    </div>
+    """
+
+@st.cache_resource(max_entries=CARD_CACHE_ENTRIES)
+def breakdown_html(version, pos, yom, _snap):
+    cube = load_duty_cube(_snap)
+    j = cube['years'][yom]
+    tax = dict(zip(DUTY_COMPONENTS, cube['values'][j, pos]))
+    rules = DEFAULT_RULE_SET
+    return f"""
+    <div class="tax-row" style="color:#4facfe; font-weight:bold; margin-bottom:5px;">Class: {cube['class'][pos]}</div>
+    <div class="tax-row"><span class="tax-label">Depreciation ({cube['depreciation'][j]:.0f}%)</span> <span class="tax-val">Applied</span></div>
+    <div class="tax-row"><span class="tax-label">Customs Value</span> <span class="tax-val">{tax['Customs Value']:,.0f}</span></div>
+    <hr style="margin:5px 0; border-color:rgba(255,255,255,0.1);">
+    <div class="tax-row"><span class="tax-label">Import Duty</span> <span class="tax-val">{tax['Import Duty']:,.0f}</span></div>
+    <div class="tax-row"><span class="tax-label">Excise Duty</span> <span class="tax-val">{tax['Excise Duty']:,.0f}</span></div>
+    <div class="tax-row"><span class="tax-label">VAT ({rules['vat'] * 100:g}%)</span> <span class="tax-val">{tax['VAT']:,.0f}</span></div>
+    <div class="tax-row"><span class="tax-label">IDF ({rules['idf'] * 100:.1f}%)</span> <span class="tax-val">{tax['IDF']:,.0f}</span></div>
+    <div class="tax-row"><span class="tax-label">RDL ({rules['rdl'] * 100:.1f}%)</span> <span class="tax-val">{tax['RDL']:,.0f}</span></div>
+    <div class="tax-row tax-total"><span class="tax-label" style="color:#4facfe">TOTAL</span> <span>{tax['Total']:,.0f}</span></div>
+    """
+
+def set_search_page(page):
+    st.session_state['search_page'] = page
+
+@st.fragment
+def render_search_grid(snap, yom, hits):
+    # Paging and breakdown toggles rerun only this fragment; each page is a fixed SEARCH_PAGE_SIZE cards,
+    # and a breakdown is built and sent only while its toggle is on
+    own_trace = current_trace() is None
+    if own_trace: start_trace("search_grid", memory=st.query_params.get("perf") == "1", yom=yom)
+    pages = max(1, -(-len(hits) // SEARCH_PAGE_SIZE))
+    page = min(st.session_state.get('search_page', 0), pages - 1)
+    page_hits = hits[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]
+
+    with span("search_render", rows=len(page_hits), page=page) as s:
+        vehicle_index = load_vehicle_index(snap)
+        cols = st.columns(3)
+        for i, pos in enumerate(page_hits):
+            with cols[i % 3]:
+                st.markdown(search_card_html(snap['version'], int(pos), yom, snap), unsafe_allow_html=True)
+                if st.toggle("TAX BREAKDOWN", key=f"breakdown_{vehicle_index['keys'][pos]}"):
+                    st.markdown(breakdown_html(snap['version'], int(pos), yom, snap), unsafe_allow_html=True)
+        s['cache'] = cache_status('search_card_html')
+
+    if pages > 1:
+        p1, p2, p3 = st.columns([1, 2, 1])
+        with p1: st.button("◀ PREV", on_click=set_search_page, args=(page - 1,), disabled=page == 0, use_container_width=True)
+        with p2: st.markdown(f"<div style='text-align:center; margin:8px 0; color:#666; font-size:0.8rem;'>PAGE {page + 1:,} OF {pages:,}</div>", unsafe_allow_html=True)
+        with p3: st.button("NEXT ▶", on_click=set_search_page, args=(page + 1,), disabled=page >= pages - 1, use_container_width=True)
+    if own_trace: finish_trace()
+
+def cache_status(name):
+    return "miss" if name in cache_misses() else "hit"
+
+def render_perf_panel(trace):
+    with st.expander("⏱ PERFORMANCE", expanded=True):
+        st.caption(f"Rerun total: {(time.perf_counter() - trace['t0']) * 1000:,.1f} ms")
+        st.dataframe(pd.DataFrame(trace['spans']), use_container_width=True, hide_index=True)
 
 # ==========================================
-# 3. CALCULATOR
+# 3. MAIN INTERFACE
 # ==========================================
-def calculate_duty_breakdown(row, yom):
-    try:
-        crsp = float(row['CRSP'])
-        cc = row['CC']
-        fuel = str(row['Fuel'])
-        
-        age = 2025 - yom
-        rates = {0:0.05, 1:0.05, 2:0.20, 3:0.30, 4:0.40, 5:0.50, 6:0.55, 7:0.60, 8:0.65}
-        depr = rates.get(age if age <= 8 else 8, 0.70)
-        
-        class_type = "Standard"
-        if "ELECTRIC" in fuel:
-            r, id_r, ex_r = 2.15325, 0.25, 0.10
-            class_type = "Electric"
-        elif (cc > 3000 and "GASOLINE" in fuel) or (cc > 2500 and "DIESEL" in fuel):
-            r, id_r, ex_r = 2.64262, 0.35, 0.35
-            class_type = "High Capacity (Excise 35%)"
-        elif cc <= 1500:
-            r, id_r, ex_r = 2.34900, 0.35, 0.20
-            class_type = "Small Capacity (Excise 20%)"
-        else:
-            r, id_r, ex_r = 2.44687, 0.35, 0.25
-            class_type = "Standard (Excise 25%)"
-
-        customs_value = (crsp / r) * (1 - depr)
-        import_duty = customs_value * id_r
-        excise_val = (customs_value + import_duty) * ex_r
-        vat_val = (customs_value + import_duty + excise_val) * 0.16
-        idf = customs_value * 0.025
-        rdl = customs_value * 0.02
-        
-        total = import_duty + excise_val + vat_val + idf + rdl
-        
-        return {
-            "Customs Value": customs_value,
-            "Import Duty": import_duty,
-            "Excise Duty": excise_val,
-            "VAT": vat_val,
-            "IDF": idf,
-            "RDL": rdl,
-            "Total": total,
-            "Depreciation": depr * 100,
-            "Class": class_type
-        }
-    except:
-        return {"Total": 0}
+def render_purchase(car_row, tax, yom, title):
+    # --- URL SAFE FORMATTING ---
+    search_term = f"{car_row['Make']} {car_row['Model']}".replace(" ", "+")
+
+    beforward_link = f"https://www.beforward.jp/stocklist/keywords={search_term}/year_from={yom}/year_to={yom}"
+    sbt_link = f"https://www.sbtjapan.com/used-cars/?search_box=1&keywords={search_term}&year_from={yom}&year_to={yom}"
+
+    c_left, c_right = st.columns([1, 1])
+
+    with c_left:
+        st.markdown(f"""
+        <div class="purchase-card">
+            <h3 style="color:#4facfe; margin:0; text-transform:uppercase;">{title}</h3>
+            <div style="font-size:0.8rem; color:#aaa; margin-bottom:15px;">{yom} MODEL | {car_row['CC']} CC | {car_row['Fuel']}</div>
+        </div>
+        """, unsafe_allow_html=True)
+
+        # NATIVE BUTTONS
+        cb1, cb2 = st.columns(2)
+        with cb1:
+            st.link_button("🇯🇵 BE FORWARD", beforward_link, use_container_width=True)
+        with cb2:
+            st.link_button("🇯🇵 SBT JAPAN", sbt_link, use_container_width=True)
+
+        st.markdown('<div style="text-align:center; font-size:0.75rem; color:#888; font-style:italic; margin-top:5px;">*Links open in a new tab</div>', unsafe_allow_html=True)
+
+        st.info("💡 **Step 1:** Click the buttons above to find live prices.\n\n💡 **Step 2:** Note the **CNF Price (USD)**.\n\n💡 **Step 3:** Enter the price on the right.")
+
+    with c_right:
+        st.markdown('<div class="filter-box">', unsafe_allow_html=True)
+        st.markdown("**LANDED COST SIMULATOR**")
+
+        cnf_usd = st.number_input("Enter CNF Price (USD)", min_value=0, value=6500, step=100)
+        ex_rate = st.number_input("Exchange Rate (KES/$)", min_value=100.0, value=DEFAULT_EX_RATE, step=0.1)
+
+        cnf_kes = cnf_usd * ex_rate
+        duty_pay = tax.get('Total', 0)
+
+        port_charges = LANDED_FEES["Port & Shipping Line"]
+        carrier_fees = LANDED_FEES["Carrier Fees"]
+        clearing = LANDED_FEES["Clearing"]
+        reg_fees = LANDED_FEES["Registration"]
+        misc = LANDED_FEES["Misc. Logistics"]
+
+        total_landed = landed_cost(cnf_usd, ex_rate, duty_pay)
+
+        st.markdown("---")
+        st.markdown(f"""
+        <div class="tax-row"><span class="tax-label">Vehicle Cost (CNF)</span> <span class="tax-val">{cnf_kes:,.0f}</span></div>
+        <div class="tax-row"><span class="tax-label">KRA Duty (Est.)</span> <span class="tax-val">{duty_pay:,.0f}</span></div>
+        <div class="tax-row"><span class="tax-label">Port & Shipping Line</span> <span class="tax-val">{port_charges:,.0f}</span></div>
+        <div class="tax-row"><span class="tax-label">Clearing & Registration</span> <span class="tax-val">{clearing + reg_fees:,.0f}</span></div>
+        <div class="tax-row"><span class="tax-label">Carrier Fees</span> <span class="tax-val">{carrier_fees:,.0f}</span></div>
+        <div class="tax-row"><span class="tax-label">Misc. Logistics</span> <span class="tax-val">{misc:,.0f}</span></div>
+
+        <div style="margin-top:20px; padding:15px; background:rgba(79, 172, 254, 0.1); border:1px solid #4facfe; border-radius:10px; text-align:center;">
+            <div style="font-size:0.8rem; color:#4facfe;">TOTAL ESTIMATED DRIVE-AWAY COST</div>
+            <div style="font-size:1.8rem; font-weight:900; color:white;">KES {total_landed:,.0f}</div>
+        </div>
+        """, unsafe_allow_html=True)
+        st.markdown('</div>', unsafe_allow_html=True)
+
+    st.markdown('<div class="section-header">PRICE & EXCHANGE RATE SENSITIVITY</div>', unsafe_allow_html=True)
+    cnf_grid = np.unique(np.linspace(cnf_usd * 0.7, cnf_usd * 1.3, 7).round(-1))
+    ex_grid = np.round(ex_rate + np.arange(-6, 7, 2), 1)
+    grid = landed_cost_grid(cnf_grid, ex_grid, duty_pay)
+    heat = grid.stack().rename_axis(['CNF (USD)', 'KES/$']).reset_index(name='Landed Cost')
+    s1, s2 = st.columns([1, 1])
+    with s1:
+        st.vega_lite_chart(heat, SENSITIVITY_SPEC, use_container_width=True)
+    with s2:
+        table = grid.map(lambda v: f"{v:,.0f}")
+        table.index = [f"${v:,.0f}" for v in grid.index]
+        table.columns = [f"{v:.1f}" for v in grid.columns]
+        st.dataframe(table, use_container_width=True)
+
+def render_deep_link(snap, code, yom):
+    # ?code=...&yom=... renders only this quote; the tabs and their indexes are skipped entirely
+    df = snap['df']
+    with span("deep_link", code=code, yom=yom) as s:
+        vehicle_index = load_vehicle_index(snap)
+        pos = resolve_vehicle_key(vehicle_index, code)
+        s['cache'] = cache_status('load_vehicle_index')
+        if st.button("← FULL CALCULATOR"):
+            st.query_params.clear()
+            st.rerun()
+        if pos is None:
+            st.error(f"No vehicle found for code {code}")
+            return
+        cube = load_duty_cube(snap)
+        if cube is not None and yom in cube['years']: tax = duty_for_year(cube, yom).iloc[pos]
+        else: tax = calculate_duty_frame(df.iloc[[pos]], yom).iloc[0]
+        st.markdown('<div class="section-header">IMPORT COST CALCULATOR</div>', unsafe_allow_html=True)
+        render_purchase(df.iloc[pos], tax, yom, vehicle_index['labels'][pos])
 
-# ==========================================
-# 4. MAIN INTERFACE
-# ==========================================
 def main():
-    df, error = load_data()
+    trace = start_trace("rerun", memory=st.query_params.get("perf") == "1")
+    with span("load_data") as s:
+        snap, changes = load_snapshot()
+        df, error = snap['df'], snap['error']
+        s['rows'] = len(df)
+        s['version'] = snap['version']
+        s['cache'] = cache_status('load_data')
+    if changes is not None and snap['version'] > 1:
+        st.toast(f"Catalogue updated: {changes['added']:,} added, {changes['changed']:,} changed, {changes['removed']:,} removed")
+    if not df.empty:
+        # Files that failed to load are left out (or kept at their last good copy) rather than failing the page
+        for path, problem in snap['source_errors'].items():
+            st.warning(f"Catalogue file {os.path.basename(path)} could not be loaded and was skipped: {problem}")
 
     st.markdown("<h2 class='main-title'>KENYA VEHICLE DUTY CALCULATOR</h2>", unsafe_allow_html=True)
 
+    link_code = st.query_params.get("code")
+    if link_code and not df.empty:
+        try: link_yom = int(st.query_params.get("yom", YOM_YEARS[-1]))
+        except ValueError: link_yom = YOM_YEARS[-1]
+        render_deep_link(snap, link_code, link_yom)
+        if st.query_params.get("perf") == "1": render_perf_panel(trace)
+        st.markdown('<div class="footer-credit">Created by Marcel Byron</div>', unsafe_allow_html=True)
+        finish_trace()
+        return
+
     c1, c2, c3 = st.columns([1, 2, 1])
     with c2:
         st.markdown('<div class="section-header">YEAR OF MANUFACTURE</div>', unsafe_allow_html=True)
-        years = list(range(2025, 2017, -1))
-        yom = st.selectbox("Year of Manufacture", years, index=years.index(2018), label_visibility="collapsed")
+        yom = st.selectbox("Year of Manufacture", YOM_YEARS, index=len(YOM_YEARS) - 1, label_visibility="collapsed")
 
     if not df.empty:
-        df['Tax_Data'] = df.apply(lambda row: calculate_duty_breakdown(row, yom), axis=1)
-        df['Duty'] = df['Tax_Data'].apply(lambda x: x['Total'])
+        with span("duty", yom=yom) as s:
+            cube = load_duty_cube(snap)
+            tax_df = duty_for_year(cube, yom) if cube is not None and yom in cube['years'] else calculate_duty_frame(df, yom)
+            duty = tax_df['Total'].to_numpy()
+            s['rows'] = len(tax_df)
+            s['cache'] = cache_status('load_data')
+
+        vehicle_index = load_vehicle_index(snap)
 
-        tab1, tab2, tab3, tab4 = st.tabs(["SEARCH", "MARKET TRENDS", "COMPARISON", "💰 PURCHASE UNIT"])
+        tab1, tab2, tab3, tab4, tab5 = st.tabs(["SEARCH", "MARKET TRENDS", "COMPARISON", "💰 PURCHASE UNIT", "⚖ TAX SCENARIOS"])
 
         # --- TAB 1: SEARCH ---
         with tab1:
@@ -243,101 +496,105 @@ def main():
             with sc2:
                 query = st.text_input("", placeholder="TYPE MAKE OR MODEL (e.g. TOYOTA PRADO)...", label_visibility="collapsed")
 
-            filtered = df.copy()
-            if query:
-                filtered = filtered[filtered['Search_Name'].str.contains(query, case=False, na=False)]
-            
-            filtered = filtered.sort_values('Duty', ascending=True)
-            st.markdown(f"<div style='text-align:center; margin:15px 0; color:#666; font-size:0.8rem;'>FOUND {len(filtered)} VEHICLES</div>", unsafe_allow_html=True)
-
-            cols = st.columns(3)
-            for i, (idx, row) in enumerate(filtered.head(60).iterrows()):
-                with cols[i % 3]:
-                    duty_fmt = f"{row['Duty']:,.0f}"
-                    cc_display = f"{row['CC']} CC" if row['CC'] > 0 else "⚡ EV"
-                    
-                    st.markdown(f"""
-                    <div class="unit-card">
-                        <div class="car-title" title="{row['Search_Name']}">{row['Search_Name']}</div>
-                        <div style="font-size:0.7rem; color:#666; text-align:center;">ESTIMATED DUTY</div>
-                        <div class="duty-price">KES {duty_fmt}</div>
-                        <div class="spec-grid">
-                            <div class="spec-item">{cc_display}</div>
-                            <div class="spec-item">{row['Fuel']}</div>
-                            <div class="spec-item">{row['Transmission']}</div>
-                            <div class="spec-item">{row['Drive']}</div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    with st.expander("TAX BREAKDOWN"):
-                        tax = row['Tax_Data']
-                        st.markdown(f"""
-                        <div class="tax-row" style="color:#4facfe; font-weight:bold; margin-bottom:5px;">Class: {tax.get('Class','-')}</div>
-                        <div class="tax-row"><span class="tax-label">Depreciation ({tax.get('Depreciation',0):.0f}%)</span> <span class="tax-val">Applied</span></div>
-                        <div class="tax-row"><span class="tax-label">Customs Value</span> <span class="tax-val">{tax.get('Customs Value',0):,.0f}</span></div>
-                        <hr style="margin:5px 0; border-color:rgba(255,255,255,0.1);">
-                        <div class="tax-row"><span class="tax-label">Import Duty</span> <span class="tax-val">{tax.get('Import Duty',0):,.0f}</span></div>
-                        <div class="tax-row"><span class="tax-label">Excise Duty</span> <span class="tax-val">{tax.get('Excise Duty',0):,.0f}</span></div>
-                        <div class="tax-row"><span class="tax-label">VAT (16%)</span> <span class="tax-val">{tax.get('VAT',0):,.0f}</span></div>
-                        <div class="tax-row"><span class="tax-label">IDF (2.5%)</span> <span class="tax-val">{tax.get('IDF',0):,.0f}</span></div>
-                        <div class="tax-row"><span class="tax-label">RDL (2.0%)</span> <span class="tax-val">{tax.get('RDL',0):,.0f}</span></div>
-                        <div class="tax-row tax-total"><span class="tax-label" style="color:#4facfe">TOTAL</span> <span>{tax.get('Total',0):,.0f}</span></div>
-                        """, unsafe_allow_html=True)
+            with span("search_filter") as s:
+                search_index = load_search_index(snap)
+                if search_index is not None:
+                    hits = search_catalogue(search_index, query) if query else search_index['order']
+                else:
+                    hits = np.flatnonzero(df['Search_Name'].str.contains(query, case=False, na=False, regex=False).to_numpy()) if query else np.arange(len(df))
+                    hits = hits[np.argsort(duty[hits], kind='stable')]
+                found = len(hits)
+                # A new query starts again from its first page
+                if st.session_state.get('search_query') != query:
+                    st.session_state['search_query'] = query
+                    st.session_state['search_page'] = 0
+                s['rows'] = found
+                s['cache'] = cache_status('load_search_index')
+            st.markdown(f"<div style='text-align:center; margin:15px 0; color:#666; font-size:0.8rem;'>FOUND {found} VEHICLES</div>", unsafe_allow_html=True)
+
+            render_search_grid(snap, yom, hits)
 
         # --- TAB 2: MARKET TRENDS ---
         with tab2:
             st.markdown('<div class="section-header">MARKET ANALYSIS</div>', unsafe_allow_html=True)
             st.markdown('<div class="filter-box">', unsafe_allow_html=True)
             
-            def smart_sort(opts):
-                try: return sorted(opts, key=lambda x: float(str(x).replace(',','')) if str(x).replace('.','').isdigit() else x)
-                except: return sorted(opts)
-
-            f1, f2, f3 = st.columns(3)
-            with f1: sel_drive = st.multiselect("Drive Config", smart_sort(df['Drive'].unique()))
-            with f2: sel_fuel = st.multiselect("Fuel Type", smart_sort(df['Fuel'].unique()))
-            with f3: sel_trans = st.multiselect("Transmission", smart_sort(df['Transmission'].unique()))
-            
-            f4, f5, f6 = st.columns(3)
-            with f4: sel_cc = st.multiselect("Engine CC", sorted(df['CC'].unique()))
-            with f5: sel_seats = st.multiselect("Seating", smart_sort(df['Seating'].unique()))
-            with f6: sel_body = st.multiselect("Body Type", smart_sort(df['Category'].unique()))
+            facet_index = load_facet_index(snap)
+            selections = {}
+            for col, _ in FACETS:
+                # A catalogue refresh can drop an option a session still has selected
+                lookup = facet_index['facets'][col]['lookup']
+                selections[col] = [v for v in st.session_state.get(f"facet_{col}", []) if v in lookup]
+                if f"facet_{col}" in st.session_state: st.session_state[f"facet_{col}"] = selections[col]
+            counts = facet_counts(facet_index, selections)
+
+            facet_cols = st.columns(3) + st.columns(3)
+            for fc, (col, label) in zip(facet_cols, FACETS):
+                facet = facet_index['facets'][col]
+                col_counts = counts[col]
+                with fc:
+                    st.multiselect(label, facet['options'], key=f"facet_{col}",
+                                   format_func=lambda v, f=facet, c=col_counts: f"{v} ({c[f['lookup'][v]]})")
             
             st.markdown('</div>', unsafe_allow_html=True)
             
-            market_df = df.copy()
-            if sel_drive: market_df = market_df[market_df['Drive'].isin(sel_drive)]
-            if sel_fuel: market_df = market_df[market_df['Fuel'].isin(sel_fuel)]
-            if sel_trans: market_df = market_df[market_df['Transmission'].isin(sel_trans)]
-            if sel_cc: market_df = market_df[market_df['CC'].isin(sel_cc)]
-            if sel_seats: market_df = market_df[market_df['Seating'].isin(sel_seats)]
-            if sel_body: market_df = market_df[market_df['Category'].isin(sel_body)]
-            
-            market_df = market_df.sort_values('Duty', ascending=True)
-            market_df['Estimated Duty'] = market_df['Duty'].apply(lambda x: f"KES {x:,.0f}")
+            with span("market_filter") as s:
+                order = search_index['order'] if search_index is not None else np.argsort(duty, kind='stable')
+                positions = market_positions(facet_index, order, selections)
+                # Only the displayed columns of the matching rows are materialised
+                market_cols = ['Search_Name', 'Category', 'CC', 'Fuel', 'Drive', 'Transmission', 'Seating']
+                market_df = df.iloc[positions, df.columns.get_indexer(market_cols)]
+                market_df = market_df.assign(**{'Estimated Duty': [f"KES {x:,.0f}" for x in duty[positions]]})
+                s['rows'] = len(market_df)
+                s['cache'] = cache_status('load_facet_index')
+
+            e1, e2 = st.columns([1, 3])
+            with e1: export_fmt = st.selectbox("Report Format", list(EXPORT_FORMATS), label_visibility="collapsed")
+            with e2:
+                signature = tuple((col, tuple(vals)) for col, vals in selections.items())
+                file_name, mime = EXPORT_FORMATS[export_fmt]
+                st.download_button("📥 DOWNLOAD REPORT", lambda: export_report(export_fmt, yom, signature, snap), file_name, mime=mime)
+
+            with span("market_render", rows=len(market_df)):
+                st.dataframe(market_df, use_container_width=True, hide_index=True)
+
+            st.markdown('<div class="section-header">MARKET ROLLUPS</div>', unsafe_allow_html=True)
+            with span("market_rollups", yom=yom) as s:
+                rollups = load_market_rollups(snap)
+                rollup_year = load_rollup_year(snap['version'], yom, snap)
+                s['cache'] = cache_status('load_rollup_year')
+                group_col = st.selectbox("Group By", [c for c, _ in ROLLUP_DIMENSIONS], format_func=dict(ROLLUP_DIMENSIONS).get, key="rollup_dim")
+                if any(selections.values()):
+                    rows = unpack_mask(facet_index, facet_mask(facet_index, selections))
+                    stats = rollup_stats(rollups['dims'][group_col], duty, rows)
+                    hist = duty_histogram(duty, rollup_year['edges'], rows)
+                else:
+                    stats, hist = rollup_year['stats'][group_col], rollup_year['histogram']
+                s['rows'] = len(stats)
 
-            out = BytesIO()
-            with pd.ExcelWriter(out, engine='xlsxwriter') as writer:
-                market_df.drop(columns=['Tax_Data']).to_excel(writer, index=False)
-            st.download_button("📥 DOWNLOAD REPORT", out.getvalue(), "market_report.xlsx", mime="application/vnd.ms-excel")
+                g1, g2 = st.columns([1, 1])
+                with g1:
+                    st.vega_lite_chart(stats.nlargest(ROLLUP_CHART_GROUPS, 'Vehicles'), ROLLUP_GROUP_SPEC, use_container_width=True)
+                with g2:
+                    edges = rollup_year['edges']
+                    hist_df = pd.DataFrame({'From': edges[:-1], 'To': edges[1:], 'Vehicles': hist})
+                    st.vega_lite_chart(hist_df, ROLLUP_HISTOGRAM_SPEC, use_container_width=True)
 
-            st.dataframe(market_df[['Search_Name', 'Category', 'CC', 'Fuel', 'Drive', 'Transmission', 'Seating', 'Estimated Duty']], use_container_width=True, hide_index=True)
+                table = stats.rename(columns={'Group': dict(ROLLUP_DIMENSIONS)[group_col]})
+                for c in ['Min', 'Median', 'P90', 'Max']: table[c] = [f"KES {x:,.0f}" for x in table[c]]
+                st.dataframe(table, use_container_width=True, hide_index=True)
 
         # --- TAB 3: COMPARISON ---
-        with tab3:
+        with tab3, span("comparison"):
             st.markdown('<div class="section-header">SIDE-BY-SIDE COMPARISON</div>', unsafe_allow_html=True)
-            choices = st.multiselect("SELECT VEHICLES", df['Search_Name'].unique())
+            choices = st.multiselect("SELECT VEHICLES", vehicle_index['keys'],
+                                     format_func=lambda k: vehicle_index['labels'][vehicle_index['by_key'][k]])
             
             if choices:
-                comp_df = df[df['Search_Name'].isin(choices)].copy()
-                comp_df = comp_df.sort_values('Duty', ascending=True)
+                comp_pos = np.array([vehicle_index['by_key'][k] for k in choices])
+                comp_pos = comp_pos[np.argsort(duty[comp_pos], kind='stable')]
+                comp_df = df.iloc[comp_pos].assign(Duty=duty[comp_pos], Display_Name=vehicle_index['labels'][comp_pos])
                 comp_df['Estimated Duty'] = comp_df['Duty'].apply(lambda x: f"KES {x:,.0f}")
-                
-                if comp_df['Search_Name'].duplicated().any():
-                    comp_df['Display_Name'] = comp_df['Search_Name'] + " (" + comp_df.index.astype(str) + ")"
-                else:
-                    comp_df['Display_Name'] = comp_df['Search_Name']
 
                 c1, c2 = st.columns([1, 1])
                 with c1:
@@ -349,85 +606,87 @@ def main():
                     st.bar_chart(comp_df.set_index('Display_Name')['Duty'])
 
         # --- TAB 4: PURCHASE UNIT (DEEP-LINKED) ---
-        with tab4:
+        with tab4, span("purchase"):
             st.markdown('<div class="section-header">IMPORT COST CALCULATOR</div>', unsafe_allow_html=True)
             
             pc1, pc2, pc3 = st.columns([1, 2, 1])
             with pc2:
-                selected_car = st.selectbox("Select Vehicle to Import", df['Search_Name'].unique())
+                selected_key = st.selectbox("Select Vehicle to Import", vehicle_index['keys'],
+                                            format_func=lambda k: vehicle_index['labels'][vehicle_index['by_key'][k]])
             
-            if selected_car:
-                car_row = df[df['Search_Name'] == selected_car].iloc[0]
-                tax = car_row['Tax_Data']
-                
-                # --- URL SAFE FORMATTING ---
-                search_term = f"{car_row['Make']} {car_row['Model']}".replace(" ", "+")
-                
-                beforward_link = f"https://www.beforward.jp/stocklist/keywords={search_term}/year_from={yom}/year_to={yom}"
-                sbt_link = f"https://www.sbtjapan.com/used-cars/?search_box=1&keywords={search_term}&year_from={yom}&year_to={yom}"
-
-                c_left, c_right = st.columns([1, 1])
-                
-                with c_left:
-                    st.markdown(f"""
-                    <div class="purchase-card">
-                        <h3 style="color:#4facfe; margin:0; text-transform:uppercase;">{selected_car}</h3>
-                        <div style="font-size:0.8rem; color:#aaa; margin-bottom:15px;">{yom} MODEL | {car_row['CC']} CC | {car_row['Fuel']}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    # NATIVE BUTTONS
-                    cb1, cb2 = st.columns(2)
-                    with cb1:
-                        st.link_button("🇯🇵 BE FORWARD", beforward_link, use_container_width=True)
-                    with cb2:
-                        st.link_button("🇯🇵 SBT JAPAN", sbt_link, use_container_width=True)
-                        
-                    st.markdown('<div style="text-align:center; font-size:0.75rem; color:#888; font-style:italic; margin-top:5px;">*Links open in a new tab</div>', unsafe_allow_html=True)
-                    
-                    st.info("💡 **Step 1:** Click the buttons above to find live prices.\n\n💡 **Step 2:** Note the **CNF Price (USD)**.\n\n💡 **Step 3:** Enter the price on the right.")
-
-                with c_right:
-                    st.markdown('<div class="filter-box">', unsafe_allow_html=True)
-                    st.markdown("**LANDED COST SIMULATOR**")
-                    
-                    cnf_usd = st.number_input("Enter CNF Price (USD)", min_value=0, value=6500, step=100)
-                    ex_rate = st.number_input("Exchange Rate (KES/$)", min_value=100.0, value=132.0, step=0.1)
-                    
-                    cnf_kes = cnf_usd * ex_rate
-                    duty_pay = tax.get('Total', 0)
-                    
-                    # UPDATED COSTS
-                    port_charges = 120000 
-                    carrier_fees = 35000 
-                    clearing = 30000     
-                    reg_fees = 15000     
-                    misc = 20000
-                    
-                    total_landed = cnf_kes + duty_pay + port_charges + clearing + carrier_fees + reg_fees + misc
-                    
-                    st.markdown("---")
-                    st.markdown(f"""
-                    <div class="tax-row"><span class="tax-label">Vehicle Cost (CNF)</span> <span class="tax-val">{cnf_kes:,.0f}</span></div>
-                    <div class="tax-row"><span class="tax-label">KRA Duty (Est.)</span> <span class="tax-val">{duty_pay:,.0f}</span></div>
-                    <div class="tax-row"><span class="tax-label">Port & Shipping Line</span> <span class="tax-val">{port_charges:,.0f}</span></div>
-                    <div class="tax-row"><span class="tax-label">Clearing & Registration</span> <span class="tax-val">{clearing + reg_fees:,.0f}</span></div>
-                    <div class="tax-row"><span class="tax-label">Carrier Fees</span> <span class="tax-val">{carrier_fees:,.0f}</span></div>
-                    <div class="tax-row"><span class="tax-label">Misc. Logistics</span> <span class="tax-val">{misc:,.0f}</span></div>
-                    
-                    <div style="margin-top:20px; padding:15px; background:rgba(79, 172, 254, 0.1); border:1px solid #4facfe; border-radius:10px; text-align:center;">
-                        <div style="font-size:0.8rem; color:#4facfe;">TOTAL ESTIMATED DRIVE-AWAY COST</div>
-                        <div style="font-size:1.8rem; font-weight:900; color:white;">KES {total_landed:,.0f}</div>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    st.markdown('</div>', unsafe_allow_html=True)
+            if selected_key:
+                car_pos = vehicle_index['by_key'][selected_key]
+                car_row = df.iloc[car_pos]
+                tax = tax_df.iloc[car_pos]
+                st.markdown(f'<div style="text-align:center; font-size:0.75rem; margin-bottom:10px;"><a href="?code={quote(selected_key)}&yom={yom}" target="_blank">🔗 Link to this quote</a></div>', unsafe_allow_html=True)
+                render_purchase(car_row, tax, yom, vehicle_index['labels'][car_pos])
+
+            st.markdown('<div class="section-header">WHAT CAN I AFFORD?</div>', unsafe_allow_html=True)
+            a1, a2 = st.columns([1, 1])
+            with a1: budget = st.number_input("Total Budget (KES)", min_value=0, value=3_000_000, step=100_000)
+            with a2: afford_rate = st.number_input("Exchange Rate (KES/$)", min_value=100.0, value=DEFAULT_EX_RATE, step=0.1, key="afford_ex_rate")
+
+            afford_index = load_affordability_index(snap)
+            if afford_index is not None and yom in afford_index['years']:
+                afford_pos, max_cnf = affordable_vehicles(afford_index, yom, budget, afford_rate)
+                st.markdown(f"<div style='text-align:center; margin:10px 0; color:#666; font-size:0.8rem;'>{len(afford_pos):,} VEHICLES FIT A KES {budget:,.0f} BUDGET ({yom} MODEL)</div>", unsafe_allow_html=True)
+                # Most expensive duty first: the cars closest to the top of the budget
+                afford_pos, max_cnf = afford_pos[::-1], max_cnf[::-1]
+                afford_cols = ['Search_Name', 'Category', 'CC', 'Fuel']
+                afford_df = df.iloc[afford_pos, df.columns.get_indexer(afford_cols)].assign(**{
+                    'KRA Duty': [f"KES {x:,.0f}" for x in duty[afford_pos]],
+                    'Max CNF (USD)': [f"${x:,.0f}" for x in max_cnf],
+                })
+                st.dataframe(afford_df, use_container_width=True, hide_index=True)
+
+        # --- TAB 5: TAX SCENARIOS ---
+        with tab5, span("scenarios", yom=yom) as s:
+            st.markdown('<div class="section-header">TAX SCENARIOS</div>', unsafe_allow_html=True)
+            regime_cube = load_regime_cube(snap)
+            s['cache'] = cache_status('load_regime_cube')
+            keys, names = regime_cube['keys'], dict(zip(regime_cube['keys'], regime_cube['names']))
+
+            r1, r2 = st.columns([1, 2])
+            with r1: base_key = st.selectbox("Baseline Regime", keys, format_func=names.get)
+            others = [k for k in keys if k != base_key]
+            with r2: compare_keys = st.multiselect("Compare Against", others, default=others, format_func=names.get)
+
+            base = keys.index(base_key)
+            compared = [keys.index(k) for k in compare_keys]
+            totals = regime_cube['values'][:, regime_cube['years'][yom], :, DUTY_COMPONENTS.index('Total')]
+            deltas = regime_deltas(regime_cube, yom, base)
+            shown = [base] + compared
+            st.dataframe(pd.DataFrame({
+                'Regime': [regime_cube['names'][k] for k in shown],
+                'Version': [keys[k].split('@', 1)[1] for k in shown],
+                'Median Duty': [f"KES {np.median(totals[k]):,.0f}" for k in shown],
+                'Mean Change': [f"KES {deltas[k].mean():+,.0f}" for k in shown],
+                'Vehicles Up': [int((deltas[k] > 0.5).sum()) for k in shown],
+                'Vehicles Down': [int((deltas[k] < -0.5).sum()) for k in shown],
+            }), use_container_width=True, hide_index=True)
+
+            if compared:
+                # Biggest movers across the compared regimes; only those rows are materialised
+                spread = np.abs(deltas[compared]).max(axis=0)
+                top = np.argpartition(-spread, min(SCENARIO_ROWS, len(spread)) - 1)[:SCENARIO_ROWS]
+                top = top[np.argsort(-spread[top], kind='stable')]
+                scen_cols = ['Search_Name', 'Category', 'CC', 'Fuel']
+                scen_df = df.iloc[top, df.columns.get_indexer(scen_cols)].assign(**{
+                    names[base_key]: [f"KES {x:,.0f}" for x in totals[base][top]],
+                    **{f"Δ {regime_cube['names'][k]}": [f"{x:+,.0f}" for x in deltas[k][top]] for k in compared},
+                })
+                st.markdown(f"<div style='text-align:center; margin:10px 0; color:#666; font-size:0.8rem;'>TOP {len(top):,} CHANGES VS {names[base_key].upper()} ({yom} MODEL)</div>", unsafe_allow_html=True)
+                st.dataframe(scen_df, use_container_width=True, hide_index=True)
+                s['rows'] = len(scen_df)
 
     else:
         st.error("Data Load Error")
         st.write(error)
         st.file_uploader("Upload File Manually", type=['xlsx','csv'])
         
+    if st.query_params.get("perf") == "1": render_perf_panel(trace)
     st.markdown('<div class="footer-credit">Created by Marcel Byron</div>', unsafe_allow_html=True)
+    finish_trace()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+import core
+
+# Stage-by-stage benchmarks on synthetic CRSP catalogues:
+#   python bench.py --rows 1000 100000 --save-baseline     writes bench_baseline.json
+#   python bench.py --rows 1000 100000 --check             fails if a stage is slower than baseline * threshold
+
+BASELINE_FILE = 'bench_baseline.json'
+DEFAULT_ROWS = [1_000, 10_000, 100_000]
+DEFAULT_THRESHOLD = 1.5
+MIN_CHECK_SECONDS = 0.005 # stages faster than this are too noisy to gate on
+
+MAKES = ["TOYOTA", "NISSAN", "MAZDA", "SUBARU", "HONDA", "MITSUBISHI", "MERCEDES", "BMW", "AUDI", "VOLKSWAGEN", "ISUZU", "SUZUKI", "LEXUS", "BYD", "AIWAYS"]
+MODELS = ["PRADO TX", "HARRIER", "X-TRAIL", "CX-5", "FORESTER", "FIT HYBRID", "OUTLANDER", "C200", "X5 XDRIVE", "A1 SPORTBACK", "D-MAX", "ALTO VAN", "RX450H", "ATTO 3", "U5"]
+FUELS = ["GASOLINE", "DIESEL", "PETROL", "HYBRID", "ELECTRIC", "PLUG-IN HYBRID", "Diesel ", None]
+DRIVES = ["2WD", "4WD", "AWD", "FWD", "RWD", None]
+TRANSMISSIONS = ["AT", "MT", "CVT", "6AT", "8AT"]
+BODIES = ["SUV", "SEDAN", "HATCHBACK", "PICK UP", "VAN", "STATION WAGON"]
+SEATS = ["5", "7", "2", "8", None]
+
+def synthetic_catalogue(rows, seed=0):
+    # Same header mess as the KRA sheets, so the rename logic in parse_catalogue is exercised
+    rng = np.random.default_rng(seed)
+    pick = lambda pool: np.asarray(pool, dtype=object)[rng.integers(0, len(pool), rows)]
+    cc = rng.choice([660, 1000, 1300, 1500, 1800, 1998, 2500, 2800, 3000, 3500, 4500], rows)
+    cc_text = np.where(rng.random(rows) < 0.1, pd.Series(cc).map(lambda v: f"{v:,}").to_numpy(dtype=object), cc.astype(object))
+    fuel = pick(FUELS)
+    cc_text = np.where(fuel == "ELECTRIC", "63 kWh", cc_text)
+    return pd.DataFrame({
+        "Make": pick(MAKES),
+        "Model": pick(MODELS) + " " + rng.integers(1, 500, rows).astype(str).astype(object),
+        "Model \nnumber": pd.Series(rng.integers(0, 36 ** 6, rows)).map(lambda v: f"DBA-{np.base_repr(v, 36)}").to_numpy(),
+        "Transmission": pick(TRANSMISSIONS),
+        "Drive\nConfiguration": pick(DRIVES),
+        "Engine \nCapacity": cc_text,
+        "Body \nType ": pick(BODIES),
+        "GVW": rng.integers(900, 3500, rows),
+        "Seating": pick(SEATS),
+        "Fuel": fuel,
+        "CRSP (KES.)": np.round(rng.uniform(1.5e6, 3e7, rows), 2),
+    })
+
+def timed(fn, repeat):
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def run_stages(rows, repeat, workdir):
+    stages = {}
+    raw = synthetic_catalogue(rows)
+    source = os.path.join(workdir, f"crsp_{rows}.csv")
+    raw.to_csv(source, index=False)
+    # openpyxl parsing is the cold-start cost the Arrow cache exists to skip. A KRA sheet cannot hold more
+    # rows than one worksheet, so larger sizes leave the xlsx stages out and --check skips them.
+    fits_sheet = rows < core.EXCEL_SHEET_ROWS
+    if fits_sheet:
+        workbook = os.path.join(workdir, f"crsp_{rows}.xlsx")
+        raw.to_excel(workbook, index=False)
+        stages['ingest_xlsx'], _ = timed(lambda: core.parse_catalogue(workbook), repeat)
+    stages['ingest_csv'], df = timed(lambda: core.parse_catalogue(source), repeat)
+    core.write_catalogue_cache(df, source)
+    stages['ingest_cache'], _ = timed(lambda: core.read_catalogue_cache(source), repeat)
+    stages['clean_cc'], _ = timed(lambda: raw["Engine \nCapacity"].apply(core.clean_cc), repeat)
+
+    stages['duty_frame'], tax = timed(lambda: core.calculate_duty_frame(df, 2018), repeat)
+    stages['duty_cube'], cube = timed(lambda: core.build_duty_cube(df, core.YOM_YEARS), repeat)
+    stages['duty_year_switch'], _ = timed(lambda: core.duty_for_year(cube, 2020), repeat)
+    # A KRA update sheet re-pricing 1% of the rows: only those are priced, tokenised and keyed again
+    origin = np.arange(len(df))
+    update = df.iloc[::100].assign(CRSP=lambda d: d['CRSP'] * 1.05)
+    merged = pd.concat([df.drop(update.index), update])
+    merged_origin = np.concatenate([np.delete(origin, np.arange(0, len(df), 100)), (1 << 32) + np.arange(len(update))])
+    stages['row_match'], (reuse, _) = timed(lambda: core.match_catalogue_rows(origin, df, merged, merged_origin), repeat)
+    stages['duty_patch'], merged_cube = timed(lambda: core.patch_duty_cube(cube, merged, reuse, core.YOM_YEARS), repeat)
+    regimes = core.compile_rule_sets(core.RULE_SETS)
+    stages['regime_cube'], regime_cube = timed(lambda: core.build_regime_cube(df, core.YOM_YEARS, regimes), repeat)
+    stages['regime_patch'], _ = timed(lambda: core.patch_regime_cube(regime_cube, merged, reuse, core.YOM_YEARS, regimes), repeat)
+    duty = tax['Total'].to_numpy()
+    merged_duty = merged_cube['values'][0, :, core.DUTY_COMPONENTS.index('Total')]
+
+    stages['search_build'], index = timed(lambda: core.build_search_index(df, duty), repeat)
+    stages['search_patch'], _ = timed(lambda: core.patch_search_index(index, merged, merged_duty, reuse), repeat)
+    stages['vehicle_build'], vehicles = timed(lambda: core.build_vehicle_index(df), repeat)
+    stages['vehicle_patch'], _ = timed(lambda: core.patch_vehicle_index(vehicles, merged, reuse), repeat)
+    queries = ["TOYOTA PRADO", "HARIER", "X-TRA", "MERCEDES C200 1", "DBA-1"]
+    stages['search_query'], _ = timed(lambda: [core.search_catalogue(index, q) for q in queries], repeat)
+
+    stages['facet_build'], facets = timed(lambda: core.build_facet_index(df), repeat)
+    stages['facet_patch'], _ = timed(lambda: core.patch_facet_index(facets, merged, reuse), repeat)
+    selections = {"Fuel": ["DIESEL", "GASOLINE"], "Drive": ["4WD"], "CC": [2800, 3000]}
+    stages['facet_filter'], positions = timed(lambda: core.market_positions(facets, index['order'], selections), repeat)
+    stages['facet_counts'], _ = timed(lambda: core.facet_counts(facets, selections), repeat)
+
+    stages['rollup_build'], rollups = timed(lambda: core.build_market_rollups(df, index['order']), repeat)
+    stages['rollup_year'], _ = timed(lambda: core.materialise_rollups(rollups, duty), repeat)
+    rows_mask = core.unpack_mask(facets, core.facet_mask(facets, selections))
+    stages['rollup_filter'], _ = timed(lambda: [core.rollup_stats(dim, duty, rows_mask) for dim in rollups['dims'].values()], repeat)
+
+    all_rows = index['order']
+    stages['export_csv'], _ = timed(lambda: core.write_export(core.iter_export_chunks(df, duty, all_rows), "CSV", BytesIO()), repeat)
+    stages['export_parquet'], _ = timed(lambda: core.write_export(core.iter_export_chunks(df, duty, all_rows), "Parquet", BytesIO()), repeat)
+    if fits_sheet: stages['export_excel'], _ = timed(lambda: core.write_export(core.iter_export_chunks(df, duty, all_rows), "Excel", BytesIO()), repeat)
+
+    stages['lookup_keys'], keys = timed(lambda: core.build_quote_keys(df), repeat)
+    code = df['Model_Code'].iloc[rows // 2]
+    stages['lookup_single'], _ = timed(lambda: core.calculate_duty_frame(df.iloc[[int(keys['code'][code])]], 2018), repeat)
+    return stages
+
+def check(results, baseline, threshold):
+    failures = []
+    for rows, stages in results.items():
+        for stage, seconds in stages.items():
+            base = baseline.get(rows, {}).get(stage)
+            if base is None or max(base, seconds) < MIN_CHECK_SECONDS: continue
+            if seconds > base * threshold:
+                failures.append(f"{rows} rows / {stage}: {seconds:.4f}s vs baseline {base:.4f}s ({seconds / base:.2f}x)")
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark each catalogue stage on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs='+', default=DEFAULT_ROWS, help="Catalogue sizes (1k to 5M)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per stage; the fastest is kept")
+    parser.add_argument("--output", help="Write results JSON here")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action='store_true', help="Overwrite the baseline with these results")
+    parser.add_argument("--check", action='store_true', help="Exit non-zero if a stage regressed past --threshold")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+    if args.check and not args.save_baseline and not os.path.exists(args.baseline):
+        parser.error(f"no baseline at {args.baseline}; run with --save-baseline first")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir) # keep the Arrow cache out of the project directory
+        try:
+            for rows in args.rows:
+                results[str(rows)] = run_stages(rows, args.repeat, workdir)
+                print(f"{rows:>10,} rows  " + "  ".join(f"{k}={v * 1000:.1f}ms" for k, v in results[str(rows)].items()))
+        finally:
+            os.chdir(cwd)
+
+    if args.output:
+        with open(args.output, 'w') as f: json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f: json.dump(results, f, indent=2)
+    if args.check:
+        with open(args.baseline) as f: baseline = json.load(f)
+        failures = check(results, baseline, args.threshold)
+        for line in failures: print("REGRESSION " + line, file=sys.stderr)
+        if failures: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from core import DEFAULT_EX_RATE, find_catalogue_files, load_catalogue, build_quote_keys, quote_manifest, write_export
+
+# Headless bulk quoting for dealer manifests:
+#   python bulk_quote.py manifest.csv -o quotes.csv --workers 8
+
+OUTPUT_FORMATS = {".csv": "CSV", ".parquet": "Parquet", ".xlsx": "Excel"}
+
+_catalogue = None
+_keys = None
+
+def init_worker(catalogue_paths, skip_errors=False):
+    # Each worker maps the catalogue once (from the Arrow cache the parent just wrote)
+    global _catalogue, _keys
+    _catalogue = load_catalogue(catalogue_paths, skip_errors)
+    _keys = build_quote_keys(_catalogue)
+
+def price_chunk(args):
+    # CSV is encoded in the worker too, since to_csv costs more than the pricing itself
+    chunk, ex_rate, csv_header = args
+    quoted = quote_manifest(_catalogue, _keys, chunk, ex_rate)
+    if csv_header is None: return len(quoted), quoted
+    return len(quoted), quoted.to_csv(index=False, header=csv_header).encode('utf-8')
+
+def read_manifest_chunks(path, chunk_rows):
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, chunksize=chunk_rows, dtype=str)
+        return
+    sheet = load_workbook(path, read_only=True).active
+    rows = sheet.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None: return
+    batch = []
+    for r in rows:
+        batch.append(r)
+        if len(batch) == chunk_rows:
+            yield pd.DataFrame(batch, columns=header)
+            batch = []
+    if batch: yield pd.DataFrame(batch, columns=header)
+
+def ordered_map(executor, fn, items, window):
+    # Like executor.map but never reads more than `window` chunks ahead, keeping memory flat
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window: yield pending.popleft().result()
+    while pending: yield pending.popleft().result()
+
+def report_progress(results, started):
+    done = 0
+    for n, payload in results:
+        done += n
+        elapsed = time.perf_counter() - started
+        print(f"\r{done:,} rows  {done / elapsed if elapsed else 0:,.0f} rows/s", end='', file=sys.stderr, flush=True)
+        yield payload
+    print(file=sys.stderr)
+
+def write_results(payloads, fmt, sink):
+    if fmt == "CSV":
+        for payload in payloads: sink.write(payload)
+    else:
+        write_export(payloads, fmt, sink)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Price a dealer manifest against the CRSP catalogue.")
+    parser.add_argument("manifest", help="CSV or XLSX with make/model or model code, YOM and CNF USD")
+    parser.add_argument("-o", "--output", required=True, help="Output file (.csv, .parquet or .xlsx)")
+    parser.add_argument("--catalogue", action="append", help="CRSP catalogue file; repeat to merge several (default: every .xlsx/.csv in the working directory)")
+    parser.add_argument("--ex-rate", type=float, default=DEFAULT_EX_RATE, help="Exchange rate KES/$")
+    parser.add_argument("--chunk-size", type=int, default=20_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    fmt = OUTPUT_FORMATS.get(os.path.splitext(args.output)[1].lower())
+    if fmt is None: parser.error(f"unsupported output type: {args.output}")
+    catalogue_paths = args.catalogue or find_catalogue_files()
+    if not catalogue_paths: parser.error("no catalogue file found")
+
+    started = time.perf_counter()
+    init_worker(catalogue_paths, not args.catalogue) # also builds the Arrow cache before any worker starts
+    jobs = ((chunk, args.ex_rate, (i == 0) if fmt == "CSV" else None)
+            for i, chunk in enumerate(read_manifest_chunks(args.manifest, args.chunk_size)))
+
+    with open(args.output, 'wb') as sink:
+        if args.workers <= 1:
+            write_results(report_progress(map(price_chunk, jobs), started), fmt, sink)
+        else:
+            with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(catalogue_paths, not args.catalogue)) as pool:
+                write_results(report_progress(ordered_map(pool, price_chunk, jobs, args.workers * 2), started), fmt, sink)
+
+if __name__ == "__main__":
+    main()
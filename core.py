@@ -0,0 +1,1265 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+import os
+import hashlib
+import json
+import re
+import threading
+import time
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Streamlit-free catalogue, duty and landed-cost logic shared by app.py and the headless tools
+
+logger = logging.getLogger("cartaxcalc.catalogue")
+
+# ==========================================
+# 1. DATA LOADER
+# ==========================================
+CACHE_DIR = '.catalogue_cache'
+CACHE_VERSION = '4'
+CATALOGUE_EXTENSIONS = ('.xlsx', '.csv')
+REFRESH_INTERVAL = 5.0 # seconds between directory scans for new or edited catalogue files
+
+# A vehicle is the same listing across sources when all of these agree
+VEHICLE_KEY_COLUMNS = ['Make', 'Model', 'Model_Code', 'CC', 'Fuel', 'Transmission', 'Drive']
+
+def clean_cc(x):
+    try: return int(''.join(filter(str.isdigit, str(x))))
+    except: return 0
+
+def clean_headers(df):
+    df.columns = [str(c).strip().replace('\n', ' ') for c in df.columns]
+    return df
+
+def catalogue_rename_map(columns):
+    rename_map = {}
+    for col in columns:
+        c_lower = col.lower()
+        if 'capacity' in c_lower and 'cc' not in rename_map.values(): rename_map[col] = 'CC'
+        elif 'body' in c_lower: rename_map[col] = 'Category'
+        elif 'crsp' in c_lower: rename_map[col] = 'CRSP'
+        elif 'drive' in c_lower: rename_map[col] = 'Drive'
+        elif 'seat' in c_lower: rename_map[col] = 'Seating'
+        elif 'fuel' in c_lower: rename_map[col] = 'Fuel'
+        elif 'trans' in c_lower: rename_map[col] = 'Transmission'
+        elif 'model' in c_lower and 'number' in c_lower: rename_map[col] = 'Model_Code'
+    return rename_map
+
+def is_catalogue_sheet(columns):
+    # Motor cycle, tractor and template sheets in the same workbook lack a Make/CRSP header row
+    names = {catalogue_rename_map(columns).get(c, c) for c in columns}
+    return {'Make', 'CRSP'} <= names
+
+def normalise_catalogue(df):
+    df = clean_headers(df).rename(columns=catalogue_rename_map(df.columns))
+
+    df['CRSP'] = pd.to_numeric(df['CRSP'], errors='coerce').fillna(0)
+    df = df[df['CRSP'] > 0] # Filter invalid prices
+    
+    if 'CC' in df.columns: df['CC'] = df['CC'].apply(clean_cc)
+    else: df['CC'] = 0
+
+    for c in ['Make', 'Model', 'Fuel', 'Transmission', 'Drive', 'Category', 'Seating']:
+        if c not in df.columns:
+            df[c] = "-" 
+        else:
+            # astype(str) keeps NaN as NaN under pandas 3's str dtype, so it is filled as well as replaced
+            df[c] = df[c].astype(str).str.upper().str.strip().replace(['NAN', 'NONE'], '-').fillna('-')
+
+    df['Search_Name'] = df['Make'] + " " + df['Model']
+    return df
+
+def parse_catalogue(target):
+    if target.endswith('.csv'): df = pd.read_csv(target)
+    else: df = pd.read_excel(target)
+    return compact_catalogue(normalise_catalogue(df))
+
+def parse_catalogue_sheets(target):
+    # Every qualifying sheet, stacked in workbook order and tagged with its position for merge precedence
+    if target.endswith('.csv'): sheets = [pd.read_csv(target)]
+    else: sheets = list(pd.read_excel(target, sheet_name=None).values())
+    frames = []
+    for i, sheet in enumerate(sheets):
+        if not is_catalogue_sheet(clean_headers(sheet).columns): continue
+        frames.append(normalise_catalogue(sheet).assign(_sheet=i))
+    if not frames: return pd.DataFrame()
+    return compact_catalogue(pd.concat(frames) if len(frames) > 1 else frames[0])
+
+def text_columns(df):
+    # object columns, plus pandas 3's str dtype (and "string"), which is not object any more
+    return [c for c, t in df.dtypes.items() if t == object or pd.api.types.is_string_dtype(t)]
+
+def compact_catalogue(df):
+    # Leftover mixed columns (e.g. GVW "1130(1045)" next to ints) are kept as text so the frame round-trips through Arrow
+    text = text_columns(df)
+    for c in text:
+        df[c] = df[c].map(lambda v: None if pd.isna(v) else str(v)).astype(object)
+    # Categorical strings and int32 CC; CRSP stays float64 so duty still agrees to the shilling
+    for c in text:
+        df[c] = df[c].astype('category')
+    if df['CC'].max() <= np.iinfo(np.int32).max: df['CC'] = df['CC'].astype(np.int32)
+    return df
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def catalogue_cache_path(target):
+    # Keyed by the absolute path too, so same-named catalogues in different folders keep separate caches
+    tag = hashlib.sha256(os.path.abspath(target).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"{os.path.basename(target)}.{tag}.arrow")
+
+def source_stat(target):
+    s = os.stat(target)
+    return f"{s.st_mtime_ns}:{s.st_size}"
+
+def read_catalogue_cache(target, sha256=None):
+    # Returns the cached frame if it was built from the current source, else None. A caller that has
+    # already hashed the file passes sha256, and then the cache must match it whatever the stat says.
+    path = catalogue_cache_path(target)
+    if not os.path.exists(path): return None
+    try:
+        reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+        meta = reader.schema.metadata or {}
+        if meta.get(b'cache_version', b'').decode() != CACHE_VERSION: return None
+        touched = meta.get(b'source_stat', b'').decode() != source_stat(target)
+        # Touched but possibly unchanged (e.g. re-copied); fall back to the content hash
+        if touched and sha256 is None: sha256 = file_sha256(target)
+        if sha256 is not None and meta.get(b'source_sha256', b'').decode() != sha256: return None
+        table = reader.read_all()
+        # Record the new mtime and size so later cold starts skip the hash again
+        if touched: write_cache_table(table, target, sha256)
+        return table.to_pandas(split_blocks=True)
+    except Exception:
+        return None
+
+def write_catalogue_cache(df, target, sha256=None):
+    try:
+        write_cache_table(pa.Table.from_pandas(df, preserve_index=True), target, sha256 or file_sha256(target))
+    except Exception:
+        pass # A frame Arrow cannot convert is simply not cached
+
+def write_cache_table(table, target, sha256):
+    path = catalogue_cache_path(target)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            b'cache_version': CACHE_VERSION.encode(),
+            b'source_stat': source_stat(target).encode(),
+            b'source_sha256': sha256.encode(),
+        })
+        tmp = path + '.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+    except Exception:
+        pass # Cache is best-effort; the parsed frame is still returned
+
+def find_catalogue_files(directory='.'):
+    # Sorted so parallel loads and precedence ties are deterministic; "~$" files are Excel lock files
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                  if f.endswith(CATALOGUE_EXTENSIONS) and not f.startswith('~$'))
+
+def try_call(fn, *args):
+    # The result, or the exception it raised, so one bad file never stops a batch
+    try: return fn(*args)
+    except Exception as e: return e
+
+def worker_context():
+    # Never plain fork: the app server and the API are threaded. A forkserver that has already imported
+    # this module starts each worker without paying the pandas import again.
+    if 'forkserver' not in multiprocessing.get_all_start_methods(): return multiprocessing.get_context('spawn')
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload([__name__])
+    return ctx
+
+def load_catalogue_sources(paths, hashes=None):
+    # path -> parsed frame, or the exception that file raised. Cache hits are memory maps and CSV parsing is
+    # mostly C-level, so both run on threads. openpyxl is pure Python under the GIL, so workbooks that miss
+    # the cache are parsed in worker processes when there are at least two of them and two cores to use.
+    hashes = hashes or {}
+    with ThreadPoolExecutor(max_workers=min(8, len(paths) or 1)) as pool:
+        frames = dict(zip(paths, pool.map(lambda p: read_catalogue_cache(p, hashes.get(p)), paths)))
+    misses = [p for p in paths if frames[p] is None]
+    workbooks = [p for p in misses if not p.endswith('.csv')]
+    workers = min(len(workbooks), os.cpu_count() or 1)
+    if workers < 2: workbooks = []
+    threaded = [p for p in misses if p not in workbooks]
+    with ThreadPoolExecutor(max_workers=min(8, len(threaded) or 1)) as pool:
+        frames.update(zip(threaded, pool.map(lambda p: try_call(parse_catalogue_sheets, p), threaded)))
+    if workbooks:
+        with ProcessPoolExecutor(workers, mp_context=worker_context()) as pool:
+            frames.update(zip(workbooks, pool.map(try_call, [parse_catalogue_sheets] * len(workbooks), workbooks)))
+    for p in misses:
+        if not isinstance(frames[p], Exception): write_catalogue_cache(frames[p], p, hashes.get(p))
+    return frames
+
+def describe_error(e):
+    return f"{type(e).__name__}: {e}"
+
+def row_hashes(df, columns=None):
+    # 64-bit per-row hashes of the cell values (not the categorical codes), comparable across frames
+    cols = [c for c in (columns or df.columns) if c in df.columns]
+    # A categorical hashes its whole category list, so a small slice of a big catalogue hashes as plain values
+    sub = df[cols].astype({c: object for c in cols if isinstance(df[c].dtype, pd.CategoricalDtype)
+                           and len(df[c].cat.categories) > len(df)})
+    return pd.Index(pd.util.hash_pandas_object(sub, index=False).to_numpy())
+
+def tag_catalogue_source(frame, source_id):
+    # Done once per parsed file: every row gets its origin (source id << 32 | row) and vehicle key hash,
+    # so later merges never re-hash or re-tag the files that did not change
+    if frame.empty: return frame
+    return frame.assign(_origin=(source_id << 32) + np.arange(len(frame)),
+                        _key=row_hashes(frame, VEHICLE_KEY_COLUMNS).to_numpy())
+
+def concat_catalogue(parts):
+    # pd.concat only keeps a categorical when every part has the same categories; aligning them first
+    # avoids turning each string column back into objects and re-categorising the whole catalogue
+    if len(parts) == 1: return parts[0]
+    shared = [c for c in parts[0].columns if all(c in p.columns and isinstance(p[c].dtype, pd.CategoricalDtype) for p in parts)]
+    dtypes = {}
+    for c in shared:
+        cats = parts[0][c].cat.categories
+        for p in parts[1:]: cats = cats.union(p[c].cat.categories, sort=False)
+        dtypes[c] = pd.CategoricalDtype(cats)
+    df = pd.concat([p.astype(dtypes) for p in parts])
+    for c in shared: df[c] = df[c].cat.remove_unused_categories()
+    return df
+
+def merge_catalogue_sources(frames):
+    # Precedence: frames are given oldest source first and sheets run in workbook order; a vehicle key
+    # found in a later sheet replaces every earlier row with that key. Repeats inside one sheet are kept
+    # as published, so a single file loads exactly as before.
+    parts = [part for df in frames if not df.empty for _, part in df.groupby('_sheet', sort=True)]
+    if not parts: return pd.DataFrame()
+    seen, kept = pd.Index([], dtype=np.uint64), []
+    for part in reversed(parts):
+        keys = pd.Index(part['_key'].to_numpy()) if '_key' in part.columns else row_hashes(part, VEHICLE_KEY_COLUMNS)
+        kept.append(part[~keys.isin(seen)])
+        seen = seen.append(keys.unique())
+    kept.reverse()
+    return compact_catalogue(concat_catalogue(kept).drop(columns=['_sheet', '_key'], errors='ignore'))
+
+def source_precedence(path, mtime=None):
+    return (os.path.getmtime(path) if mtime is None else mtime, path)
+
+def load_catalogue(paths, skip_errors=False):
+    # One-shot merged load for the headless tools; the app keeps a refreshable store instead.
+    # skip_errors drops files that fail to parse (with a warning) rather than failing the whole load.
+    sources = load_catalogue_sources(paths)
+    for p, df in list(sources.items()):
+        if not isinstance(df, Exception): continue
+        if not skip_errors: raise df
+        logger.warning("Skipping catalogue %s: %s", p, describe_error(df))
+        del sources[p]
+    ordered = [sources[p] for p in sorted(sources, key=source_precedence)]
+    return merge_catalogue_sources(ordered).drop(columns='_origin', errors='ignore')
+
+def scan_catalogue_sources(paths, sources, ids):
+    # Hashes each file and parses only those whose content changed, tagging each new frame with its source
+    # id. Failures are returned rather than raised, so one unreadable file never blocks the others.
+    with ThreadPoolExecutor(max_workers=min(8, len(paths) or 1)) as pool:
+        hashes = dict(zip(paths, pool.map(lambda p: try_call(file_sha256, p), paths)))
+    scans = {}
+    for p, sha256 in hashes.items():
+        if isinstance(sha256, Exception): scans[p] = {"error": describe_error(sha256)}
+        elif p in sources and sources[p]['sha256'] == sha256: scans[p] = {"sha256": sha256}
+    changed = [p for p in paths if p not in scans]
+    for p, df in load_catalogue_sources(changed, hashes).items():
+        if not isinstance(df, Exception): df = try_call(tag_catalogue_source, df, ids[p])
+        scans[p] = {"error": describe_error(df)} if isinstance(df, Exception) else {"sha256": hashes[p], "frame": df}
+    return scans
+
+def new_snapshot(version, df=None, cube=None, error=None, changes=None, source_errors=None, origin=None, reuse=None, base=None):
+    # An immutable view of the catalogue. Derived indexes are added to "indexes" on first use; a refreshed
+    # snapshot patches them from its base's copies, where "reuse" maps each row to an identical base row.
+    return {
+        "version": version,
+        "df": pd.DataFrame() if df is None else df,
+        "cube": cube,
+        "error": error,
+        "changes": changes,
+        "source_errors": source_errors or {},
+        "origin": origin,
+        "reuse": reuse,
+        "indexes": {},
+        "base_indexes": None if base is None else base['indexes'],
+        "lock": threading.RLock(),
+    }
+
+def new_catalogue_store(directory='.'):
+    return {
+        "directory": directory,
+        "lock": threading.Lock(),
+        "checked": None,
+        "sources": {}, # path -> stat signature, sha256, mtime, version id, tagged frame and last error
+        "merged": None, # source ids behind the current snapshot, in precedence order
+        "next_id": 1,
+        "snapshot": new_snapshot(0, error="No file found"),
+    }
+
+def catalogue_error(source_errors):
+    if not source_errors: return "No file found"
+    return "\n".join(f"{os.path.basename(p)}: {e}" for p, e in source_errors.items())
+
+def refresh_catalogue_store(store, force=False):
+    # Rescans at most every REFRESH_INTERVAL seconds and swaps in a new snapshot only when the merged rows
+    # changed; unchanged rows keep their duty cube rows and index entries. Returns the change counts or None.
+    if not force and store['checked'] is not None and time.monotonic() - store['checked'] < REFRESH_INTERVAL: return None
+    with store['lock']:
+        if not force and store['checked'] is not None and time.monotonic() - store['checked'] < REFRESH_INTERVAL: return None
+        store['checked'] = time.monotonic()
+        sources, old = store['sources'], store['snapshot']
+        try:
+            paths = find_catalogue_files(store['directory'])
+        except OSError as e:
+            logger.warning("Cannot list catalogue directory %s: %s", store['directory'], e)
+            if not old['version']: store['snapshot'] = {**old, "error": str(e)}
+            return None
+        stats = {}
+        for p in paths:
+            try: stats[p] = os.stat(p)
+            except OSError: pass # gone since the listing; handled as removed
+        stale = [p for p, s in stats.items() if p not in sources or sources[p]['stat'] != (s.st_mtime_ns, s.st_size)]
+        removed = [p for p in sources if p not in stats]
+        ids = {p: store['next_id'] + i for i, p in enumerate(stale)}
+        store['next_id'] += len(stale)
+        scans = scan_catalogue_sources(stale, sources, ids)
+
+        for p in stale:
+            s, scan = stats[p], scans[p]
+            source = {"id": None, "frame": None, "sha256": None, "mtime": s.st_mtime, **sources.get(p, {}),
+                      "stat": (s.st_mtime_ns, s.st_size), "error": scan.get('error')}
+            if 'error' in scan:
+                # The last good copy (if any) stays merged until the file parses again
+                logger.warning("Skipping catalogue %s: %s", p, scan['error'])
+            else:
+                source.update(sha256=scan['sha256'], mtime=s.st_mtime)
+                if 'frame' in scan: source.update(id=ids[p], frame=scan['frame'])
+            sources[p] = source
+        for p in removed: del sources[p]
+
+        source_errors = {p: sources[p]['error'] for p in sorted(sources) if sources[p]['error']}
+        ordered = [p for p in sorted(sources, key=lambda p: source_precedence(p, sources[p]['mtime']))
+                   if sources[p]['frame'] is not None and not sources[p]['frame'].empty]
+        merged = [sources[p]['id'] for p in ordered]
+        if merged == store['merged']:
+            # No rows changed (e.g. a file without a catalogue sheet, or a re-saved copy): same version
+            if source_errors != old['source_errors']:
+                store['snapshot'] = {**old, "source_errors": source_errors, "error": old['error'] and catalogue_error(source_errors)}
+            return None
+        store['merged'] = merged
+
+        df = merge_catalogue_sources([sources[p]['frame'] for p in ordered])
+        if df.empty:
+            changes = {"added": 0, "changed": 0, "removed": len(old['df'])}
+            store['snapshot'] = new_snapshot(old['version'] + 1, error=catalogue_error(source_errors), changes=changes, source_errors=source_errors)
+            return changes
+
+        origin = df.pop('_origin').to_numpy()
+        reuse, changes = match_catalogue_rows(old['origin'], old['df'], df, origin)
+        if len(df) == len(old['df']) and not any(changes.values()):
+            # Same rows from re-tagged sources (e.g. only a non-catalogue sheet was edited): keep the version
+            # and its row order, and adopt the new origins. reuse is then a permutation of the old rows.
+            kept_origin = np.empty_like(origin)
+            kept_origin[reuse] = origin
+            store['snapshot'] = {**old, "origin": kept_origin, "source_errors": source_errors}
+            return None
+        cube = patch_duty_cube(old['cube'], df, reuse, YOM_YEARS)
+        store['snapshot'] = new_snapshot(old['version'] + 1, df, cube, changes=changes, source_errors=source_errors,
+                                         origin=origin, reuse=reuse, base=old)
+        return changes
+
+def snapshot_index(snap, name, build, patch=None):
+    # Derived indexes live on the snapshot they describe. After a refresh, one the previous snapshot had
+    # built is patched through snap['reuse'] instead of rebuilt; build(snap) / patch(old_index, snap).
+    with snap['lock']:
+        if name in snap['indexes']: return snap['indexes'][name]
+        base = snap['base_indexes']
+        if patch is not None and base is not None and base.get(name) is not None:
+            index = patch(base[name], snap)
+        else:
+            index = build(snap)
+        snap['indexes'][name] = index
+        # Once everything the base had is carried over, let the base indexes go
+        if base is not None and set(base) <= set(snap['indexes']): snap['base_indexes'] = None
+        return index
+
+# ==========================================
+# 2. CALCULATOR
+# ==========================================
+DUTY_COMPONENTS = ["Customs Value", "Import Duty", "Excise Duty", "VAT", "IDF", "RDL", "Total"]
+
+# Tax rules are data: one JSON file per rule-set version, so Finance Act proposals sit next to the KRA regime
+RULE_SET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rule_sets')
+DEFAULT_RULE_SET_ID = 'kra-crsp'
+RULE_SET_FIELDS = ['id', 'version', 'name', 'reference_year', 'depreciation_by_age', 'depreciation_future',
+                   'high_capacity_cc', 'small_capacity_cc', 'classes', 'vat', 'idf', 'rdl']
+# Classes are listed in np.select order: electric, high capacity, small capacity, then everything else
+RULE_SET_CLASSES = 4
+
+def load_rule_sets(directory=RULE_SET_DIR):
+    rule_sets = []
+    for f in sorted(os.listdir(directory)):
+        if not f.endswith('.json'): continue
+        with open(os.path.join(directory, f)) as fh: rs = json.load(fh)
+        missing = [k for k in RULE_SET_FIELDS if k not in rs]
+        if missing: raise ValueError(f"{f}: rule set is missing {', '.join(missing)}")
+        if len(rs['classes']) != RULE_SET_CLASSES: raise ValueError(f"{f}: expected {RULE_SET_CLASSES} duty classes")
+        rule_sets.append(rs)
+    # The default regime first, then the rest by id; within an id the newest version takes the earlier slot,
+    # whatever each version's display name says. Two stable sorts, since versions run newest first: a
+    # revision such as "2025.07-1" has one more number than "2025.07" and must sort ahead of it.
+    rule_sets.sort(key=lambda rs: [int(p) for p in re.findall(r'\d+', rs['version'])], reverse=True)
+    rule_sets.sort(key=lambda rs: (rs['id'] != DEFAULT_RULE_SET_ID, rs['id']))
+    return rule_sets
+
+def rule_set_key(rs):
+    return f"{rs['id']}@{rs['version']}"
+
+RULE_SETS = load_rule_sets()
+DEFAULT_RULE_SET = RULE_SETS[0]
+
+# Selectable years of manufacture, newest first, counted back from the default regime's reference year so a
+# new rule set moves the selector, the duty cubes and the parity years with it
+YOM_CHOICES = 8
+YOM_YEARS = list(range(DEFAULT_RULE_SET['reference_year'], DEFAULT_RULE_SET['reference_year'] - YOM_CHOICES, -1))
+
+DEPRECIATION_RATES = dict(enumerate(DEFAULT_RULE_SET['depreciation_by_age']))
+
+# (class label, r, import duty rate, excise rate) in np.select order
+DUTY_CLASSES = [(c['label'], c['r'], c['import_duty'], c['excise']) for c in DEFAULT_RULE_SET['classes']]
+
+def compile_rule_sets(rule_sets):
+    # Stacks N rule sets into arrays indexed [regime] or [regime, class] so the engine can broadcast over them
+    fuels = sorted({fuel for rs in rule_sets for fuel in rs['high_capacity_cc']})
+    ages = max(len(rs['depreciation_by_age']) for rs in rule_sets)
+    classes = lambda field: np.array([[c[field] for c in rs['classes']] for rs in rule_sets], dtype=np.float64)
+    scalars = lambda field: np.array([rs[field] for rs in rule_sets], dtype=np.float64)
+    return {
+        "keys": [rule_set_key(rs) for rs in rule_sets],
+        "names": [rs['name'] for rs in rule_sets],
+        "reference_year": np.array([rs['reference_year'] for rs in rule_sets]),
+        # Ages past the end of a shorter table keep its last rate, as DEPRECIATION_RATES does for age > 8
+        "depreciation": np.array([rs['depreciation_by_age'] + rs['depreciation_by_age'][-1:] * (ages - len(rs['depreciation_by_age']))
+                                  for rs in rule_sets]),
+        "depreciation_future": scalars('depreciation_future'),
+        "fuels": fuels,
+        "high_cc": np.array([[rs['high_capacity_cc'].get(f, np.inf) for f in fuels] for rs in rule_sets]).reshape(len(rule_sets), len(fuels)),
+        "small_cc": scalars('small_capacity_cc'),
+        "labels": np.array([[c['label'] for c in rs['classes']] for rs in rule_sets], dtype=object),
+        "r": classes('r'),
+        "import_duty": classes('import_duty'),
+        "excise": classes('excise'),
+        "vat": scalars('vat'),
+        "idf": scalars('idf'),
+        "rdl": scalars('rdl'),
+    }
+
+DEFAULT_REGIME = compile_rule_sets([DEFAULT_RULE_SET])
+
+def duty_inputs(df):
+    crsp = pd.to_numeric(df['CRSP'], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    cc = pd.to_numeric(df['CC'], errors='coerce').fillna(0).to_numpy()
+    fuel = df['Fuel'] if isinstance(df['Fuel'].dtype, pd.CategoricalDtype) else df['Fuel'].astype(str) # .str on a categorical only scans the categories
+    return crsp, cc, fuel
+
+def classify_vehicles(compiled, cc, fuel):
+    # (regime x vehicle) index into DUTY_CLASSES order; the fuel text is scanned once for every regime
+    is_ev = fuel.str.contains("ELECTRIC", regex=False).to_numpy()
+    flags = np.array([fuel.str.contains(f, regex=False).to_numpy() for f in compiled['fuels']]).reshape(len(compiled['fuels']), len(cc))
+    is_high = ((cc > compiled['high_cc'][:, :, None]) & flags).any(axis=1)
+    is_small = cc <= compiled['small_cc'][:, None]
+    return np.select([np.broadcast_to(is_ev, is_high.shape), is_high, is_small], [0, 1, 2], default=3)
+
+def regime_depreciation(compiled, yom):
+    # (regime, *yom.shape) rates; yom may be a scalar, one YOM per row, or a list of years
+    yom = np.asarray(yom)
+    age = compiled['reference_year'].reshape((-1,) + (1,) * yom.ndim) - yom
+    rows = np.arange(len(compiled['keys'])).reshape(age.shape[:1] + (1,) * yom.ndim)
+    table = compiled['depreciation'][rows, np.clip(age, 0, compiled['depreciation'].shape[1] - 1)]
+    return np.where(age < 0, compiled['depreciation_future'].reshape(rows.shape), table)
+
+def fill_duty_components(out, crsp, r, id_r, ex_r, depr, vat, idf, rdl):
+    # Writes the DUTY_COMPONENTS columns of out in place; every argument broadcasts against out[..., 0]
+    cv, imp, exc, vat_v, idf_v, rdl_v, total = (out[..., k] for k in range(len(DUTY_COMPONENTS)))
+    np.multiply(crsp / r, 1 - depr, out=cv)
+    np.multiply(cv, id_r, out=imp)
+    np.multiply(cv + imp, ex_r, out=exc)
+    np.multiply(cv + imp + exc, vat, out=vat_v)
+    np.multiply(cv, idf, out=idf_v)
+    np.multiply(cv, rdl, out=rdl_v)
+    np.add(imp, exc, out=total)
+    total += vat_v
+    total += idf_v
+    total += rdl_v
+    return out
+
+def depreciation_rate(yom):
+    # Vectorised DEPRECIATION_RATES.get(min(age, oldest), future); yom may be a scalar or an array
+    return regime_depreciation(DEFAULT_REGIME, yom)[0]
+
+def calculate_duty_breakdown(row, yom):
+    try:
+        crsp = float(row['CRSP'])
+        cc = row['CC']
+        fuel = str(row['Fuel'])
+        
+        rules = DEFAULT_RULE_SET
+        age = rules['reference_year'] - yom
+        oldest = len(rules['depreciation_by_age']) - 1
+        depr = DEPRECIATION_RATES.get(age if age <= oldest else oldest, rules['depreciation_future'])
+        
+        if "ELECTRIC" in fuel: cls = 0
+        elif any(cc > limit and key in fuel for key, limit in rules['high_capacity_cc'].items()): cls = 1
+        elif cc <= rules['small_capacity_cc']: cls = 2
+        else: cls = 3
+        class_type, r, id_r, ex_r = DUTY_CLASSES[cls]
+
+        customs_value = (crsp / r) * (1 - depr)
+        import_duty = customs_value * id_r
+        excise_val = (customs_value + import_duty) * ex_r
+        vat_val = (customs_value + import_duty + excise_val) * rules['vat']
+        idf = customs_value * rules['idf']
+        rdl = customs_value * rules['rdl']
+        
+        total = import_duty + excise_val + vat_val + idf + rdl
+        
+        return {
+            "Customs Value": customs_value,
+            "Import Duty": import_duty,
+            "Excise Duty": excise_val,
+            "VAT": vat_val,
+            "IDF": idf,
+            "RDL": rdl,
+            "Total": total,
+            "Depreciation": depr * 100,
+            "Class": class_type
+        }
+    except:
+        return {"Total": 0}
+
+def calculate_duty_frame(df, yom):
+    # Columnar twin of calculate_duty_breakdown: one pass over the whole catalogue under the default regime
+    crsp, cc, fuel = duty_inputs(df)
+    class_idx = classify_vehicles(DEFAULT_REGIME, cc, fuel)[0]
+    depr = depreciation_rate(yom)
+
+    out = np.empty((len(df), len(DUTY_COMPONENTS)))
+    fill_duty_components(out, crsp, DEFAULT_REGIME['r'][0][class_idx], DEFAULT_REGIME['import_duty'][0][class_idx],
+                         DEFAULT_REGIME['excise'][0][class_idx], depr,
+                         DEFAULT_REGIME['vat'][0], DEFAULT_REGIME['idf'][0], DEFAULT_REGIME['rdl'][0])
+
+    frame = pd.DataFrame(out, columns=DUTY_COMPONENTS, index=df.index)
+    frame['Depreciation'] = np.broadcast_to(depr * 100, len(df)).copy()
+    frame['Class'] = DEFAULT_REGIME['labels'][0][class_idx]
+    return frame
+
+def build_duty_cube(df, years):
+    # Stored year-major (YOM x vehicle x component) so each year is one contiguous block
+    values = np.empty((len(years), len(df), len(DUTY_COMPONENTS)))
+    depr = np.empty(len(years))
+    classes = None
+    for j, yom in enumerate(years):
+        frame = calculate_duty_frame(df, yom)
+        values[j] = frame[DUTY_COMPONENTS].to_numpy()
+        depr[j] = frame['Depreciation'].iloc[0] if len(frame) else 0
+        if classes is None: classes = pd.Categorical(frame['Class'], categories=[c[0] for c in DUTY_CLASSES])
+    return {
+        "years": {yom: j for j, yom in enumerate(years)},
+        "values": values,
+        "depreciation": depr,
+        "class": classes,
+        "index": df.index,
+    }
+
+def duty_for_year(cube, yom):
+    j = cube['years'][yom]
+    tax_df = pd.DataFrame(cube['values'][j], columns=DUTY_COMPONENTS, index=cube['index'], copy=False)
+    tax_df['Depreciation'] = cube['depreciation'][j]
+    tax_df['Class'] = cube['class']
+    return tax_df
+
+def match_catalogue_rows(old_origin, old_df, df, origin):
+    # For each merged row, the position of an old row with identical content (-1 when there is none), so
+    # the duty cube and every index can copy what they derived for it. origin tags each row with
+    # (source version << 32 | row): rows from untouched files match without hashing, and rows from a
+    # changed file are matched by content.
+    if old_origin is None or old_df.empty:
+        return np.full(len(df), -1), {"added": len(df), "changed": 0, "removed": len(old_df)}
+    old_origin = pd.Index(old_origin)
+    reuse = old_origin.get_indexer(origin)
+    fresh = np.flatnonzero(reuse < 0)
+    dropped = np.flatnonzero(~old_origin.isin(origin))
+    # Search_Name is Make + Model again and is the slowest column to hash
+    cols = [c for c in df.columns if c in old_df.columns and c != 'Search_Name']
+    fresh_hash = row_hashes(df.iloc[fresh], cols)
+    dropped_hash = row_hashes(old_df.iloc[dropped], cols)
+    # The k-th new copy of a repeated row pairs with the k-th old copy, so an unchanged file matches one-to-one
+    pair = pd.MultiIndex.from_arrays([dropped_hash, repeat_ordinal(dropped_hash.to_numpy())]).get_indexer(
+        pd.MultiIndex.from_arrays([fresh_hash, repeat_ordinal(fresh_hash.to_numpy())]))
+    reuse[fresh[pair >= 0]] = dropped[pair[pair >= 0]]
+    # Extra copies still derive identically to any old copy, but count as added rows
+    first = np.flatnonzero(~dropped_hash.duplicated())
+    spare = np.where(pair < 0, dropped_hash[first].get_indexer(fresh_hash), -1)
+    reuse[fresh[spare >= 0]] = dropped[first[spare[spare >= 0]]]
+
+    # An edited row shows up as a dropped old row and an unmatched new row with the same vehicle key
+    priced = fresh[pair < 0]
+    gone = dropped[~np.isin(np.arange(len(dropped)), pair)]
+    priced_keys = row_hashes(df.iloc[priced], VEHICLE_KEY_COLUMNS)
+    gone_keys = row_hashes(old_df.iloc[gone], VEHICLE_KEY_COLUMNS)
+    changed = int(priced_keys.isin(gone_keys).sum())
+    return reuse, {"added": len(priced) - changed, "changed": changed, "removed": int((~gone_keys.isin(priced_keys)).sum())}
+
+def patch_duty_cube(cube, df, reuse, years):
+    # Rows with a match in the old cube are copied; only the rest (reuse < 0) are priced
+    if cube is None or list(cube['years']) != list(years): return build_duty_cube(df, years)
+    priced = np.flatnonzero(reuse < 0)
+    # One gather for every row; the priced rows are then overwritten
+    values = cube['values'][:, np.maximum(reuse, 0)]
+    codes = cube['class'].codes[np.maximum(reuse, 0)]
+    if len(priced):
+        # Every (YOM, priced row) pair in one vectorised pass rather than one pass per year
+        frame = calculate_duty_frame(df.iloc[np.tile(priced, len(years))], np.repeat(list(years), len(priced)))
+        values[:, priced] = frame[DUTY_COMPONENTS].to_numpy().reshape(len(years), len(priced), -1)
+        codes[priced] = pd.Categorical(frame['Class'].iloc[:len(priced)], categories=cube['class'].categories).codes
+    return {
+        "years": cube['years'],
+        "values": values,
+        "depreciation": cube['depreciation'],
+        "class": pd.Categorical.from_codes(codes, categories=cube['class'].categories),
+        "index": df.index,
+    }
+
+def build_regime_cube(df, years, compiled):
+    # Catalogue x YOM x regime in one broadcast pass, laid out (regime, YOM, vehicle, component)
+    crsp, cc, fuel = duty_inputs(df)
+    class_idx = classify_vehicles(compiled, cc, fuel)
+    rows = np.arange(len(compiled['keys']))[:, None]
+    depr = regime_depreciation(compiled, years)
+    rate = lambda field: compiled[field][rows, class_idx][:, None, :]
+    scalar = lambda field: compiled[field][:, None, None]
+
+    values = np.empty((len(compiled['keys']), len(years), len(df), len(DUTY_COMPONENTS)))
+    fill_duty_components(values, crsp, rate('r'), rate('import_duty'), rate('excise'), depr[:, :, None],
+                         scalar('vat'), scalar('idf'), scalar('rdl'))
+    return {
+        "keys": compiled['keys'],
+        "names": compiled['names'],
+        "years": {yom: j for j, yom in enumerate(years)},
+        "values": values,
+        "depreciation": depr,
+        "class": class_idx.astype(np.int8),
+        "labels": compiled['labels'],
+        "index": df.index,
+    }
+
+def patch_regime_cube(old, df, reuse, years, compiled):
+    # Same as patch_duty_cube across every regime: copy matched rows, compute the rest in one pass
+    if old['keys'] != compiled['keys'] or list(old['years']) != list(years): return build_regime_cube(df, years, compiled)
+    fresh = np.flatnonzero(reuse < 0)
+    values = old['values'][:, :, np.maximum(reuse, 0)]
+    classes = old['class'][:, np.maximum(reuse, 0)]
+    if len(fresh):
+        part = build_regime_cube(df.iloc[fresh], years, compiled)
+        values[:, :, fresh] = part['values']
+        classes[:, fresh] = part['class']
+    return {**old, "values": values, "class": classes, "index": df.index}
+
+def regime_deltas(regime_cube, yom, base=0, component='Total'):
+    # (regime x vehicle) change against the base regime for one YOM; the base row is all zeros
+    values = regime_cube['values'][:, regime_cube['years'][yom], :, DUTY_COMPONENTS.index(component)]
+    return values - values[base]
+
+# ==========================================
+# 3. SEARCH INDEX
+# ==========================================
+TOKEN_RE = re.compile(r'[A-Z0-9]+')
+MARK_RE = re.compile(r'[^A-Z0-9\s]') # punctuation in names, indexed so punctuation-only queries skip the full scan
+FUZZY_MIN_SCORE = 0.5
+SPARSE_UNION_RATIO = 16 # postings below 1/16 of the rows are de-duplicated by sorting, else with a row mask
+
+def trigrams(token):
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def sorted_unique(values):
+    # np.unique by sorting: its hash-based path is far slower on large integer arrays in recent NumPy
+    values = np.sort(values)
+    return values[np.concatenate([[True], values[1:] != values[:-1]])] if len(values) else values
+
+def word_grams(words, ids, n):
+    # {gram: sorted int32 ids of the words containing it} for every length-n substring, and each word's count
+    # of distinct grams. Runs on a fixed-width code-point matrix instead of one Python set per word; code
+    # points fit in 21 bits, so a gram of up to three characters packs into one int64.
+    words = np.asarray(words, dtype=str)
+    counts = np.zeros(len(words), dtype=np.int32)
+    width = words.dtype.itemsize // 4
+    if not len(words) or width < n: return counts, {}
+    chars = words.view(np.uint32).reshape(len(words), width).astype(np.int64)
+    packed = chars[:, :width - n + 1].copy()
+    for k in range(1, n): packed = (packed << 21) | chars[:, k:width - n + 1 + k]
+    row, col = np.nonzero(np.arange(width - n + 1) + n <= np.char.str_len(words)[:, None])
+    codes, uniques = pd.factorize(packed[row, col])
+    pair = sorted_unique(row.astype(np.int64) * len(uniques) + codes) # one entry per (word, gram), word-major
+    row, codes = pair // len(uniques), pair % len(uniques)
+    counts[:] = np.bincount(row, minlength=len(words))
+    order = np.argsort(codes, kind='stable') # keeps word order, so each id list comes out sorted
+    split = np.searchsorted(codes[order], np.arange(1, len(uniques)))
+    mask = (1 << 21) - 1
+    grams = [''.join(chr((int(u) >> (21 * (n - 1 - k))) & mask) for k in range(n)) for u in uniques]
+    return counts, dict(zip(grams, np.split(np.asarray(ids, dtype=np.int32)[row[order]], split)))
+
+EMPTY_SEARCH_INDEX = {
+    "order": np.empty(0, dtype=np.intp),
+    "names": np.empty(0, dtype=object),
+    "vocab": np.empty(0, dtype=str),
+    "bounds": np.zeros(1, dtype=np.intp),
+    "posting_ranks": np.empty(0, dtype=np.int32),
+    "posting_codes": np.empty(0, dtype=np.int32),
+    "trigrams": {},
+    "short": {},
+    "marks": {},
+    "gram_counts": np.empty(0, dtype=np.int32),
+}
+
+def search_text(df):
+    # (make + model, make + model + code), upper-cased
+    names = (df['Make'].astype(str) + ' ' + df['Model'].astype(str)).str.upper()
+    text = names
+    if 'Model_Code' in df.columns: text = text + ' ' + df['Model_Code'].astype(object).fillna('').astype(str).str.upper()
+    return names.to_numpy(dtype=object), text.to_numpy(dtype=object)
+
+def build_search_index(df, duty):
+    return patch_search_index(EMPTY_SEARCH_INDEX, df, duty, np.full(len(df), -1))
+
+def patch_search_index(old, df, duty, reuse):
+    # reuse[i] is the old row whose words row i still has (-1: tokenise it). Kept rows carry their postings
+    # over to their new rank; only the other rows are tokenised and only unseen words get trigrams and
+    # short grams. Words no row uses any more stay in the vocabulary with empty postings. Punctuation marks
+    # in a row's name are posted as one-character words of their own.
+    # Depreciation is one factor per YOM, so duty order is the same for every year
+    order = np.argsort(np.asarray(duty), kind='stable')
+    src = np.asarray(reuse)[order]
+    kept, fresh = np.flatnonzero(src >= 0), np.flatnonzero(src < 0)
+    old_rank = np.empty(len(old['order']), dtype=np.intp)
+    old_rank[old['order']] = np.arange(len(old['order']))
+    src_rank = old_rank[src[kept]]
+
+    # Old postings regrouped by rank, then gathered for each kept row
+    by_rank = np.argsort(old['posting_ranks'], kind='stable')
+    counts = np.bincount(old['posting_ranks'], minlength=len(old['order']))
+    lens = counts[src_rank]
+    at = np.arange(lens.sum()) + np.repeat((np.cumsum(counts) - counts)[src_rank] - (np.cumsum(lens) - lens), lens)
+    kept_codes = old['posting_codes'][by_rank[at]]
+    kept_ranks = np.repeat(kept, lens)
+
+    names = np.empty(len(df), dtype=object)
+    names[kept] = old['names'][src_rank]
+    names[fresh], text = search_text(df.iloc[order[fresh]])
+    tokens = pd.concat([pd.Series(text, index=fresh).str.findall(TOKEN_RE).explode(),
+                        pd.Series(names[fresh], index=fresh, dtype=object).str.findall(MARK_RE).explode()]).dropna()
+    tokens = tokens[~pd.MultiIndex.from_arrays([tokens.index, tokens.values]).duplicated()]
+    words = tokens.to_numpy()
+    codes = pd.Index(old['vocab']).get_indexer(words)
+    unseen = codes < 0
+    new_codes, new_words = pd.factorize(words[unseen])
+    codes[unseen] = len(old['vocab']) + new_codes
+    vocab = np.concatenate([old['vocab'], np.asarray(new_words, dtype=str)])
+
+    # Marks are only ever looked up whole; words get trigrams and short grams
+    new_ids = len(old['vocab']) + np.arange(len(new_words))
+    is_mark = np.array([bool(MARK_RE.match(w)) for w in new_words], dtype=bool)
+    marks = {**old['marks'], **dict(zip(np.asarray(new_words)[is_mark], new_ids[is_mark].tolist()))}
+    plain = [w for w, m in zip(new_words, is_mark) if not m]
+    gram_counts = np.zeros(len(new_words), dtype=np.int32)
+    # Trigrams of " word " as trigrams() gives them; 1- and 2-character substrings (at most 36 + 36 ** 2 keys
+    # over the whole vocabulary) answer short query tokens exactly
+    gram_counts[~is_mark], added = word_grams([f" {w} " for w in plain], new_ids[~is_mark], 3)
+    short_added = {**word_grams(plain, new_ids[~is_mark], 1)[1], **word_grams(plain, new_ids[~is_mark], 2)[1]}
+    # Ids only ever grow, so every list stays sorted
+    grams, short = dict(old['trigrams']), dict(old['short'])
+    for index, new in ((grams, added), (short, short_added)):
+        for g, ids in new.items():
+            index[g] = np.concatenate([index[g], ids]) if g in index else ids
+
+    # Postings flattened, sorted by word then rank, with bounds[w]:bounds[w + 1] holding word w's rows
+    key = np.sort((np.concatenate([kept_codes, codes]).astype(np.int64) << 32)
+                  | np.concatenate([kept_ranks, tokens.index.to_numpy()]).astype(np.int64))
+    posting_codes = (key >> 32).astype(np.int32)
+    return {
+        "order": order,
+        "names": names, # make and model in duty order, for queries with no token to look up
+        "vocab": vocab,
+        "bounds": np.searchsorted(posting_codes, np.arange(len(vocab) + 1)),
+        "posting_ranks": (key & 0xFFFFFFFF).astype(np.int32),
+        "posting_codes": posting_codes,
+        "trigrams": grams,
+        "short": short, # 1- and 2-character substring -> ids of the words containing it
+        "marks": marks, # punctuation mark -> its word id
+        "gram_counts": np.concatenate([old['gram_counts'], gram_counts]),
+    }
+
+def postings(index, tid):
+    return index['posting_ranks'][index['bounds'][tid]:index['bounds'][tid + 1]]
+
+def union_postings(index, tids):
+    # Sorted ranks of the rows holding any of tids; the cost follows those words' postings, not the vocabulary
+    if len(tids) == 1: return postings(index, tids[0])
+    starts = index['bounds'][tids]
+    lens = index['bounds'][np.asarray(tids) + 1] - starts
+    at = np.arange(lens.sum()) + np.repeat(starts - (np.cumsum(lens) - lens), lens)
+    ranks = index['posting_ranks'][at]
+    if len(ranks) * SPARSE_UNION_RATIO < len(index['order']): return sorted_unique(ranks)
+    hit = np.zeros(len(index['order']), dtype=bool)
+    hit[ranks] = True
+    return np.flatnonzero(hit).astype(np.int32)
+
+def infix_candidates(index, token):
+    # Vocabulary ids whose trigrams include every inner trigram of token, a superset of the words containing it.
+    # The id lists are sorted, so intersecting them from the shortest up never touches the whole vocabulary.
+    grams = index['trigrams']
+    inner = {token[i:i + 3] for i in range(len(token) - 2)}
+    if not inner <= grams.keys(): return np.empty(0, dtype=np.int32)
+    lists = sorted((grams[g] for g in inner), key=len)
+    tids = lists[0]
+    for ids in lists[1:]:
+        if not len(tids): break
+        tids = np.intersect1d(tids, ids, assume_unique=True)
+    return tids
+
+def match_token(index, token):
+    # Any token containing the query token, as the old substring search did (C200 finds GLC200)
+    vocab = index['vocab']
+    if len(token) < 3:
+        # Too short for an inner trigram; the short-gram lists already hold exactly the words containing it
+        tids = index['short'].get(token, np.empty(0, dtype=np.int32))
+    else:
+        tids = infix_candidates(index, token)
+        tids = tids[np.char.find(vocab[tids], token) >= 0]
+    if len(tids): return tids
+
+    # No substring hit: rank vocabulary by trigram overlap (Dice) so typos like PRADDO still land on PRADO
+    qgrams = trigrams(token)
+    hits = [index['trigrams'][g] for g in qgrams if g in index['trigrams']]
+    if not hits: return np.empty(0, dtype=np.intp)
+    counts = np.bincount(np.concatenate(hits), minlength=len(vocab))
+    score = 2 * counts / (len(qgrams) + index['gram_counts'])
+    score[np.diff(index['bounds']) == 0] = 0 # words left behind by a catalogue refresh
+    best = score.max()
+    if best < FUZZY_MIN_SCORE: return np.empty(0, dtype=np.intp)
+    return np.flatnonzero(score >= best - 0.1)
+
+def search_catalogue(index, query):
+    # Row positions matching every query token, cheapest duty first
+    query = query.upper()
+    tokens = TOKEN_RE.findall(query)
+    if not query: return index['order']
+    if not tokens:
+        # Punctuation or blanks only: a substring match on make and model, as before the index existed, run
+        # over the rows holding every mark in the query (or all rows for blanks alone)
+        ranks = np.arange(len(index['order']), dtype=np.int32)
+        for mark in set(MARK_RE.findall(query)):
+            tid = index['marks'].get(mark)
+            if tid is None: return index['order'][:0]
+            ranks = np.intersect1d(ranks, postings(index, tid), assume_unique=True)
+        if len(query) == 1 and query != ' ': return index['order'][ranks] # a lone mark's postings are the answer
+        return index['order'][ranks[pd.Series(index['names'][ranks]).str.contains(query, regex=False).to_numpy()]]
+    result = None
+    for token in tokens:
+        tids = match_token(index, token)
+        ranks = union_postings(index, tids) if len(tids) else np.empty(0, dtype=np.int32)
+        result = ranks if result is None else np.intersect1d(result, ranks, assume_unique=True)
+        if not len(result): break
+    return index['order'][result]
+
+def vehicle_row_parts(df):
+    # Everything about a row's key and label that depends on that row alone
+    code = df['Model_Code'].astype(object).fillna('').str.upper().str.strip() if 'Model_Code' in df.columns else pd.Series('', index=df.index)
+    code = code.to_numpy(dtype=object)
+    variant = (df['CC'].astype(str) + " " + df['Fuel'].astype(str) + " " + df['Transmission'].astype(str) + " " + df['Drive'].astype(str)).to_numpy(dtype=object)
+    names = df['Search_Name'].astype(str).to_numpy(dtype=object)
+    code_in_name = np.array([c in nm for c, nm in zip(code, names)], dtype=bool)
+    return {
+        "code": code,
+        "names": names,
+        "composite": names + " | " + variant,
+        # Labels only need to tell same-named variants apart in the selectors
+        "detail": np.where((code != '') & ~code_in_name, code + ", " + variant, variant),
+    }
+
+def build_vehicle_index(df):
+    return finish_vehicle_index(vehicle_row_parts(df))
+
+def patch_vehicle_index(old, df, reuse):
+    # Per-row parts are copied for rows with an identical old row; keys and labels are then re-derived,
+    # since a new row can make an existing Model_Code or name ambiguous
+    kept, fresh = np.flatnonzero(reuse >= 0), np.flatnonzero(reuse < 0)
+    parts = {k: np.empty(len(df), dtype=object) for k in old['parts']}
+    new = vehicle_row_parts(df.iloc[fresh])
+    for k in parts:
+        parts[k][kept] = old['parts'][k][reuse[kept]]
+        parts[k][fresh] = new[k]
+    return finish_vehicle_index(parts)
+
+def repeat_ordinal(values):
+    # 0 for the first occurrence of each value, 1 for the second, ... (hash grouping, no sort)
+    return pd.Series(values).groupby(values, sort=False).cumcount().to_numpy()
+
+def finish_vehicle_index(parts):
+    # Primary key per row: Model_Code when it is unique on its own, otherwise a composite of
+    # code/name and the variant columns, with a ~n ordinal for rows that are still identical
+    code, names, composite = parts['code'], parts['names'], parts['composite']
+    keys = np.where(code != '', code, composite)
+    clash = pd.Series(keys).duplicated(keep=False).to_numpy()
+    keys[clash] = np.where(code[clash] != '', code[clash] + " | " + composite[clash], composite[clash])
+    ordinal = repeat_ordinal(keys)
+    again = ordinal > 0
+    keys[again] = keys[again] + "~" + (ordinal[again] + 1).astype(str).astype(object)
+
+    labels = names.copy()
+    same_name = pd.Series(names).duplicated(keep=False).to_numpy()
+    labels[same_name] = names[same_name] + " (" + parts['detail'][same_name] + ")"
+    dup = repeat_ordinal(labels)
+    again = dup > 0
+    labels[again] = labels[again] + " #" + (dup[again] + 1).astype(str).astype(object)
+
+    has_code = code != ''
+    first_code = np.flatnonzero(has_code & ~pd.Series(code).duplicated().to_numpy())
+    return {
+        "keys": keys,
+        "labels": labels,
+        "by_key": dict(zip(keys, range(len(keys)))),
+        "by_code": dict(zip(code[first_code], first_code.tolist())),
+        "parts": parts,
+    }
+
+def resolve_vehicle_key(index, key):
+    # Exact primary key first, then a bare Model_Code (first catalogue row wins); None if unknown
+    if key in index['by_key']: return index['by_key'][key]
+    return index['by_code'].get(str(key).upper().strip())
+
+# ==========================================
+# 4. FACET INDEX
+# ==========================================
+FACETS = [
+    ("Drive", "Drive Config"),
+    ("Fuel", "Fuel Type"),
+    ("Transmission", "Transmission"),
+    ("CC", "Engine CC"),
+    ("Seating", "Seating"),
+    ("Category", "Body Type"),
+]
+
+def smart_sort(opts):
+    try: return sorted(opts, key=lambda x: float(str(x).replace(',','')) if str(x).replace('.','').isdigit() else x)
+    except: return sorted(opts)
+
+def facet_options(col, values):
+    return sorted(values) if col == 'CC' else smart_sort(values)
+
+def facet_entry(options, codes):
+    return {
+        "options": options,
+        "lookup": {v: k for k, v in enumerate(options)},
+        "codes": codes,
+        "bitmaps": [np.packbits(codes == k) for k in range(len(options))],
+    }
+
+def build_facet_index(df):
+    facets = {}
+    for col, _ in FACETS:
+        options = facet_options(col, df[col].unique())
+        facets[col] = facet_entry(options, pd.Categorical(df[col], categories=options).codes.astype(np.int32))
+    return {"n": len(df), "facets": facets}
+
+def patch_facet_index(old, df, reuse):
+    # Codes are copied for rows with an identical old row and looked up for the rest; options are only
+    # re-sorted when a value appears or disappears. Bitmaps are re-packed, as inserted rows shift positions.
+    kept, fresh = np.flatnonzero(reuse >= 0), np.flatnonzero(reuse < 0)
+    facets = {}
+    for col, _ in FACETS:
+        facet = old['facets'][col]
+        values = df[col].iloc[fresh]
+        options = facet['options'] + [v for v in values.unique() if v not in facet['lookup']]
+        codes = np.empty(len(df), dtype=np.int32)
+        codes[kept] = facet['codes'][reuse[kept]]
+        codes[fresh] = pd.Categorical(values, categories=options).codes
+        used = np.bincount(codes, minlength=len(options)) > 0
+        if len(options) != len(facet['options']) or not used.all():
+            live = [v for v, u in zip(options, used) if u]
+            sorted_options = facet_options(col, live)
+            remap = np.full(len(options), -1, dtype=np.int32)
+            remap[np.flatnonzero(used)] = pd.Index(sorted_options).get_indexer(live)
+            options, codes = sorted_options, remap[codes]
+        facets[col] = facet_entry(options, codes)
+    return {"n": len(df), "facets": facets}
+
+def facet_mask(index, selections, skip=None):
+    # Packed bitmap of rows passing every facet (OR within a facet, AND across facets)
+    mask = None
+    for col, values in selections.items():
+        if col == skip or not values: continue
+        facet = index['facets'][col]
+        bits = np.zeros_like(facet['bitmaps'][0]) if facet['bitmaps'] else np.zeros((index['n'] + 7) // 8, dtype=np.uint8)
+        for v in values:
+            k = facet['lookup'].get(v)
+            if k is not None: bits |= facet['bitmaps'][k]
+        mask = bits if mask is None else mask & bits
+    return mask
+
+def unpack_mask(index, mask):
+    if mask is None: return np.ones(index['n'], dtype=bool)
+    return np.unpackbits(mask, count=index['n']).astype(bool)
+
+def facet_counts(index, selections):
+    # Count per option given the other facets' selections, as in a faceted search sidebar
+    counts = {}
+    for col, facet in index['facets'].items():
+        rows = unpack_mask(index, facet_mask(index, selections, skip=col))
+        counts[col] = np.bincount(facet['codes'][rows], minlength=len(facet['options']))
+    return counts
+
+def market_positions(facet_index, order, selections):
+    # Duty-ordered row positions passing the current facet filters
+    rows = unpack_mask(facet_index, facet_mask(facet_index, selections))
+    return order[rows[order]]
+
+# ==========================================
+# 5. EXPORT
+# ==========================================
+EXPORT_CHUNK_ROWS = 50_000
+EXCEL_SHEET_ROWS = 1_048_576 # rows per worksheet, header included; xlsxwriter refuses any past it
+EXPORT_FORMATS = {
+    "Excel": ("market_report.xlsx", "application/vnd.ms-excel"),
+    "CSV": ("market_report.csv", "text/csv"),
+    "Parquet": ("market_report.parquet", "application/vnd.apache.parquet"),
+}
+
+def iter_export_chunks(df, duty, positions, chunk_rows=EXPORT_CHUNK_ROWS):
+    for start in range(0, len(positions), chunk_rows):
+        pos = positions[start:start + chunk_rows]
+        chunk = df.iloc[pos].copy()
+        chunk['Duty'] = duty[pos]
+        chunk['Estimated Duty'] = chunk['Duty'].map(lambda x: f"KES {x:,.0f}")
+        yield chunk
+
+def write_export(chunks, fmt, sink):
+    if fmt == "CSV":
+        for i, chunk in enumerate(chunks):
+            sink.write(chunk.to_csv(index=False, header=(i == 0)).encode('utf-8'))
+    elif fmt == "Parquet":
+        writer = None
+        for chunk in chunks:
+            if writer is None:
+                text = set(text_columns(chunk)) | {c for c, t in chunk.dtypes.items() if isinstance(t, pd.CategoricalDtype)}
+                schema = pa.schema([(c, pa.string() if c in text else pa.from_numpy_dtype(t)) for c, t in chunk.dtypes.items()])
+                writer = pq.ParquetWriter(sink, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        if writer is not None: writer.close()
+    else:
+        # constant_memory flushes each row as it is written, so rows must arrive in order. Rows past one
+        # sheet's limit carry on in a new sheet under the same header rather than being dropped.
+        workbook = xlsxwriter.Workbook(sink, {'constant_memory': True})
+        sheet, row, header = None, EXCEL_SHEET_ROWS, None
+        for chunk in chunks:
+            header = list(chunk.columns)
+            values = chunk.astype(object).where(chunk.notna(), None)
+            for record in values.itertuples(index=False, name=None):
+                if row == EXCEL_SHEET_ROWS:
+                    sheet = workbook.add_worksheet()
+                    sheet.write_row(0, 0, header)
+                    row = 1
+                sheet.write_row(row, 0, record)
+                row += 1
+        if sheet is None:
+            sheet = workbook.add_worksheet()
+            if header is not None: sheet.write_row(0, 0, header)
+        workbook.close()
+
+# ==========================================
+# 6. LANDED COST
+# ==========================================
+DEFAULT_EX_RATE = 132.0
+
+LANDED_FEES = {
+    "Port & Shipping Line": 120000,
+    "Carrier Fees": 35000,
+    "Clearing": 30000,
+    "Registration": 15000,
+    "Misc. Logistics": 20000,
+}
+
+def landed_cost(cnf_usd, ex_rate, duty):
+    # Works element-wise on arrays as well as on single quotes
+    return np.asarray(cnf_usd) * ex_rate + duty + sum(LANDED_FEES.values())
+
+def landed_cost_grid(cnf_usd_values, ex_rates, duty):
+    # Sensitivity table for one vehicle: rows are CNF prices (USD), columns exchange rates
+    cnf = np.asarray(cnf_usd_values, dtype=np.float64)
+    ex = np.asarray(ex_rates, dtype=np.float64)
+    return pd.DataFrame(landed_cost(cnf[:, None], ex[None, :], duty), index=cnf, columns=ex)
+
+def build_affordability_index(cube, order):
+    # Duty order is the same for every YOM, so one permutation sorts each year's totals
+    totals = cube['values'][:, :, DUTY_COMPONENTS.index('Total')]
+    return {"years": cube['years'], "order": order, "sorted_total": np.ascontiguousarray(totals[:, order])}
+
+def affordable_vehicles(index, yom, budget_kes, ex_rate):
+    # Every vehicle whose duty plus fixed fees fits the budget, with the CNF (USD) left to spend on it
+    j = index['years'][yom]
+    limit = budget_kes - sum(LANDED_FEES.values())
+    k = np.searchsorted(index['sorted_total'][j], limit, side='right')
+    return index['order'][:k], (limit - index['sorted_total'][j, :k]) / ex_rate
+
+# ==========================================
+# 7. QUOTING
+# ==========================================
+QUOTE_COLUMNS = ["Matched_Name", "Matched_Code", "Class"] + DUTY_COMPONENTS + ["CNF_KES", "Landed_Cost", "Status"]
+
+def normalise_manifest(df):
+    # Dealer manifests: make/model or model code, YOM, CNF USD under whatever headers they use
+    rename_map = {}
+    for col in df.columns:
+        c_lower = str(col).strip().lower()
+        if 'code' in c_lower or ('model' in c_lower and 'number' in c_lower): rename_map[col] = 'Model_Code'
+        elif 'make' in c_lower: rename_map[col] = 'Make'
+        elif 'model' in c_lower: rename_map[col] = 'Model'
+        elif 'yom' in c_lower or 'year' in c_lower: rename_map[col] = 'YOM'
+        elif 'cnf' in c_lower: rename_map[col] = 'CNF_USD'
+    df = df.rename(columns=rename_map)
+    for c in ['Make', 'Model', 'Model_Code']:
+        if c not in df.columns: df[c] = None
+        df[c] = df[c].map(lambda v: None if pd.isna(v) else str(v).upper().strip())
+    df['YOM'] = pd.to_numeric(df['YOM'], errors='coerce') if 'YOM' in df.columns else np.nan
+    df['CNF_USD'] = pd.to_numeric(df['CNF_USD'], errors='coerce') if 'CNF_USD' in df.columns else np.nan
+    return df
+
+def build_quote_keys(catalogue):
+    # First catalogue row wins for a repeated key, like the PURCHASE UNIT tab's iloc[0]
+    positions = pd.Series(np.arange(len(catalogue)))
+    keys = {"name": pd.Series(positions.to_numpy(), index=catalogue['Search_Name'].to_numpy())}
+    if 'Model_Code' in catalogue.columns:
+        keys['code'] = pd.Series(positions.to_numpy(), index=catalogue['Model_Code'].astype(object).fillna('').str.upper().str.strip().to_numpy())
+        # Rows without a code must not answer for manifest rows without one
+        keys['code'] = keys['code'][keys['code'].index != '']
+    return {k: v[~v.index.duplicated()] for k, v in keys.items()}
+
+def quote_manifest(catalogue, keys, manifest, ex_rate=DEFAULT_EX_RATE):
+    manifest = normalise_manifest(manifest)
+    pos = np.full(len(manifest), -1)
+    if 'code' in keys:
+        code = manifest['Model_Code'].fillna('').to_numpy()
+        pos = keys['code'].reindex(code).fillna(-1).to_numpy(dtype=int)
+        pos[code == ''] = -1 # blank or whitespace-only codes fall back to make and model
+    by_name = keys['name'].reindex((manifest['Make'].fillna('') + " " + manifest['Model'].fillna('')).to_numpy()).fillna(-1).to_numpy(dtype=int)
+    pos = np.where(pos >= 0, pos, by_name)
+
+    yom = manifest['YOM'].to_numpy()
+    cnf = manifest['CNF_USD'].to_numpy(dtype=np.float64)
+    ok = (pos >= 0) & ~np.isnan(yom) & np.isfinite(cnf)
+    out = pd.DataFrame(index=manifest.index, columns=QUOTE_COLUMNS, dtype=object)
+    out['Status'] = np.select([pos < 0, np.isnan(yom), ~np.isfinite(cnf)], ["NOT FOUND", "INVALID YOM", "INVALID CNF"], default="OK")
+    if ok.any():
+        rows = catalogue.iloc[pos[ok]]
+        tax = calculate_duty_frame(rows, yom[ok].astype(int))
+        out.loc[ok, 'Matched_Name'] = rows['Search_Name'].to_numpy()
+        if 'Model_Code' in rows.columns: out.loc[ok, 'Matched_Code'] = rows['Model_Code'].to_numpy()
+        for c in DUTY_COMPONENTS + ['Class']: out.loc[ok, c] = tax[c].to_numpy()
+        out.loc[ok, 'CNF_KES'] = cnf[ok] * ex_rate
+        out.loc[ok, 'Landed_Cost'] = landed_cost(cnf[ok], ex_rate, tax['Total'].to_numpy())
+    for c in DUTY_COMPONENTS + ['CNF_KES', 'Landed_Cost']: out[c] = pd.to_numeric(out[c])
+    return pd.concat([manifest, out], axis=1)
+
+# ==========================================
+# 8. MARKET ROLLUPS
+# ==========================================
+ROLLUP_DIMENSIONS = [
+    ("Make", "Make"),
+    ("Category", "Body Type"),
+    ("Fuel", "Fuel Type"),
+    ("CC Band", "Engine Size"),
+    ("Drive", "Drive Config"),
+]
+# Band edges sit on the duty class thresholds (1500 small, 2500 diesel, 3000 petrol)
+CC_BANDS = [1000, 1500, 2000, 2500, 3000, 4000]
+ROLLUP_BINS = 40
+ROLLUP_STATS = ["Vehicles", "Min", "Median", "P90", "Max"]
+
+def cc_band_labels():
+    edges = [0] + CC_BANDS
+    return [f"{lo + 1 if lo else 0}-{hi} CC" for lo, hi in zip(edges, edges[1:])] + [f"{CC_BANDS[-1] + 1}+ CC"]
+
+def build_market_rollups(df, order):
+    # YOM-independent part: every dimension's rows grouped, and duty-ascending within each group. order
+    # is the search index's duty order, which every YOM shares (depreciation is one factor per year).
+    dims = {}
+    for col, _ in ROLLUP_DIMENSIONS:
+        if col == "CC Band":
+            labels = np.array(cc_band_labels(), dtype=object)
+            codes = np.searchsorted(CC_BANDS, df['CC'].to_numpy(), side='left').astype(np.int32)
+        else:
+            cat = pd.Categorical(df[col])
+            labels, codes = np.asarray(cat.categories, dtype=object), cat.codes.astype(np.int32)
+        grouped = order[np.argsort(codes[order], kind='stable')]
+        dims[col] = {
+            "labels": labels,
+            "codes": codes,
+            "grouped": grouped,
+            "starts": np.searchsorted(codes[grouped], np.arange(len(labels) + 1)),
+        }
+    return {"n": len(df), "dims": dims}
+
+def rollup_stats(dim, duty, mask=None):
+    # Count / min / median / p90 / max per group (nearest-rank percentiles). A filter only masks the
+    # pre-grouped, pre-sorted rows, so no sort or group-by runs per rerun.
+    grouped, starts = dim['grouped'], dim['starts']
+    if mask is not None:
+        keep = mask[grouped]
+        grouped = grouped[keep]
+        starts = np.concatenate([[0], np.cumsum(keep)])[starts]
+    count = np.diff(starts)
+    found = np.flatnonzero(count)
+    lo, count = starts[found], count[found]
+    values = duty[grouped]
+    rank = lambda q: values[lo + np.maximum(np.ceil(q * count).astype(np.int64), 1) - 1]
+    return pd.DataFrame({
+        "Group": dim['labels'][found],
+        "Vehicles": count,
+        "Min": values[lo],
+        "Median": rank(0.5),
+        "P90": rank(0.9),
+        "Max": values[lo + count - 1],
+    })
+
+def duty_histogram_edges(duty):
+    # Log-spaced: duty runs from tens of thousands to tens of millions of shillings
+    positive = duty[duty > 0]
+    if not len(positive): return np.array([0.0, 1.0])
+    lo, hi = positive.min(), positive.max()
+    return np.geomspace(lo, max(hi, lo * 1.01), ROLLUP_BINS + 1)
+
+def duty_histogram(duty, edges, mask=None):
+    values = duty if mask is None else duty[mask]
+    bins = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    return np.bincount(bins, minlength=len(edges) - 1)
+
+def materialise_rollups(rollups, duty):
+    # Per catalogue x YOM: the unfiltered tables and histogram, which are what most reruns show
+    edges = duty_histogram_edges(duty)
+    return {
+        "edges": edges,
+        "histogram": duty_histogram(duty, edges),
+        "stats": {col: rollup_stats(dim, duty) for col, dim in rollups['dims'].items()},
+    }
@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Lightweight per-rerun timing spans. Each finished trace is one JSON line on the
+# "cartaxcalc.perf" logger, written to stderr; set PERF_LOG=/path/to/file.jsonl to append them to a file instead.
+# Traces started with memory=True, and every trace while PERF_LOG is set, also record peak_alloc_kb: the most
+# memory allocated above the span's starting point while it ran, from tracemalloc. tracemalloc slows every
+# allocation, so it only runs while such a trace is open. Its counters are process-wide, so spans running at
+# the same time on other threads count towards each other's peaks.
+
+logger = logging.getLogger("cartaxcalc.perf")
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    handler = logging.FileHandler(os.environ["PERF_LOG"]) if os.environ.get("PERF_LOG") else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.propagate = False # one line per trace even if the host app configures the root logger
+
+_local = threading.local()
+_memory_lock = threading.Lock()
+_memory_traces = 0 # open traces measuring memory; tracemalloc stops when the last one finishes
+_started_tracemalloc = False
+
+def start_memory():
+    global _memory_traces, _started_tracemalloc
+    with _memory_lock:
+        if _memory_traces == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracemalloc = True
+        _memory_traces += 1
+
+def stop_memory():
+    global _memory_traces, _started_tracemalloc
+    with _memory_lock:
+        _memory_traces -= 1
+        if _memory_traces == 0 and _started_tracemalloc:
+            tracemalloc.stop()
+            _started_tracemalloc = False
+
+def open_window():
+    # Starts a peak window for a trace or span. The window that was open is credited with the peak so far,
+    # because reset_peak discards it.
+    current, peak = tracemalloc.get_traced_memory()
+    windows = _local.windows
+    if windows: windows[-1]['peak'] = max(windows[-1]['peak'], peak)
+    tracemalloc.reset_peak()
+    windows.append({"base": current, "peak": current})
+
+def close_window():
+    # The window's peak above where it started, in KB. The enclosing window also saw that peak.
+    window = _local.windows.pop()
+    peak = max(window['peak'], tracemalloc.get_traced_memory()[1])
+    if _local.windows: _local.windows[-1]['peak'] = max(_local.windows[-1]['peak'], peak)
+    return round((peak - window['base']) / 1024, 1)
+
+def measuring_memory():
+    trace = current_trace()
+    return trace is not None and trace['memory']
+
+def start_trace(label, memory=False, **fields):
+    stale = current_trace()
+    if stale is not None and stale['memory']: stop_memory() # a rerun that raised never reached finish_trace
+    memory = memory or bool(os.environ.get("PERF_LOG"))
+    _local.trace = {"label": label, "started": time.time(), "t0": time.perf_counter(), "spans": [], "cache_misses": set(), "memory": memory, **fields}
+    _local.windows = []
+    if memory:
+        start_memory()
+        open_window()
+    return _local.trace
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def cache_misses():
+    # Names of cached loaders that ran on this thread's trace; a throwaway set when nothing is being traced
+    trace = current_trace()
+    return trace['cache_misses'] if trace is not None else set()
+
+@contextmanager
+def span(name, **fields):
+    # Yields the span record so callers can attach rows, cache hit/miss, etc.
+    record = {"span": name, **fields}
+    memory = measuring_memory()
+    if memory: open_window()
+    t0 = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['ms'] = round((time.perf_counter() - t0) * 1000, 3)
+        record['peak_alloc_kb'] = close_window() if memory else None
+        trace = current_trace()
+        if trace is not None: trace['spans'].append(record)
+
+def finish_trace():
+    trace = current_trace()
+    if trace is None: return None
+    _local.trace = None
+    trace['total_ms'] = round((time.perf_counter() - trace.pop('t0')) * 1000, 3)
+    if trace['memory']:
+        trace['peak_alloc_kb'] = close_window()
+        stop_memory()
+    else:
+        trace['peak_alloc_kb'] = None
+    trace['cache_misses'] = sorted(trace['cache_misses'])
+    logger.info(json.dumps(trace, default=str))
+    return trace
@@ -0,0 +1,142 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import core
+
+# A refreshed snapshot patches the duty cube and every derived index from the previous snapshot's copies.
+# After each kind of catalogue edit, every patched structure must equal one built from scratch on the
+# merged rows: add/edit/remove, repeated rows, a same-mtime rewrite and a touch that changes no row.
+
+CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.xlsx')
+REGIMES = core.compile_rule_sets(core.RULE_SETS)
+TOTAL = core.DUTY_COMPONENTS.index('Total')
+QUERIES = ["TOYOTA PRADO", "HARIER", "C200", "X-TRA", "1", "EDITED", "PRADDO", "-", "(", "E:H"]
+
+@pytest.fixture(scope='module')
+def raw():
+    if not os.path.exists(CATALOGUE): pytest.skip("data.xlsx not present")
+    df = pd.read_excel(CATALOGUE)
+    assert df.duplicated().any() # the published sheet repeats rows, which the matching must pair one-to-one
+    return df
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path) # keeps the Arrow cache in the temp directory
+    return core.new_catalogue_store(str(tmp_path))
+
+def crsp_column(df):
+    return next(c for c in df.columns if 'CRSP' in c)
+
+def write_source(store, df, name='crsp.csv', keep_mtime=False):
+    path = os.path.join(store['directory'], name)
+    before = os.stat(path) if keep_mtime else None
+    df.to_csv(path, index=False)
+    if keep_mtime: os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+
+def build_indexes(snap):
+    df = snap['df']
+    return {
+        "search": core.build_search_index(df, snap['cube']['values'][0, :, TOTAL]),
+        "facet": core.build_facet_index(df),
+        "vehicle": core.build_vehicle_index(df),
+        "regime": core.build_regime_cube(df, core.YOM_YEARS, REGIMES),
+    }
+
+def patch_indexes(base, snap):
+    df, reuse = snap['df'], snap['reuse']
+    return {
+        "search": core.patch_search_index(base['search'], df, snap['cube']['values'][0, :, TOTAL], reuse),
+        "facet": core.patch_facet_index(base['facet'], df, reuse),
+        "vehicle": core.patch_vehicle_index(base['vehicle'], df, reuse),
+        "regime": core.patch_regime_cube(base['regime'], df, reuse, core.YOM_YEARS, REGIMES),
+    }
+
+def live_postings(index):
+    # Words a refresh left behind keep empty postings, so only words some row still has are compared
+    return {w: core.postings(index, t).tolist() for t, w in enumerate(index['vocab']) if len(core.postings(index, t))}
+
+def assert_patched_matches_build(base, snap):
+    df = snap['df']
+    cube = core.build_duty_cube(df, core.YOM_YEARS)
+    np.testing.assert_allclose(snap['cube']['values'], cube['values'], rtol=1e-12)
+    assert (snap['cube']['depreciation'] == cube['depreciation']).all()
+    assert (np.asarray(snap['cube']['class']) == np.asarray(cube['class'])).all()
+
+    patched, built = patch_indexes(base, snap), build_indexes(snap)
+    np.testing.assert_allclose(patched['regime']['values'], built['regime']['values'], rtol=1e-12)
+    assert (patched['regime']['class'] == built['regime']['class']).all()
+
+    p, b = patched['search'], built['search']
+    assert (p['order'] == b['order']).all()
+    assert (p['names'] == b['names']).all()
+    assert live_postings(p) == live_postings(b)
+    for q in QUERIES:
+        assert (core.search_catalogue(p, q) == core.search_catalogue(b, q)).all(), q
+
+    for col, _ in core.FACETS:
+        p, b = patched['facet']['facets'][col], built['facet']['facets'][col]
+        assert p['options'] == b['options'], col
+        assert (p['codes'] == b['codes']).all(), col
+        assert all((x == y).all() for x, y in zip(p['bitmaps'], b['bitmaps'])), col
+
+    p, b = patched['vehicle'], built['vehicle']
+    assert (p['keys'] == b['keys']).all()
+    assert (p['labels'] == b['labels']).all()
+    assert p['by_key'] == b['by_key']
+    assert p['by_code'] == b['by_code']
+
+def refresh(store):
+    # Returns the refresh's change counts and the indexes the outgoing snapshot had built
+    base = build_indexes(store['snapshot'])
+    return core.refresh_catalogue_store(store, force=True), base
+
+def test_patch_matches_build_after_edits(store, raw):
+    crsp = crsp_column(raw)
+    write_source(store, raw)
+    assert core.refresh_catalogue_store(store, force=True)['added'] == len(core.load_catalogue([os.path.join(store['directory'], 'crsp.csv')]))
+
+    # Remove a block, re-price some rows, add new vehicles and one more copy of a repeated row
+    edited = raw.drop(index=range(10, 20)).copy()
+    edited.loc[100:110, crsp] = edited.loc[100:110, crsp] * 1.1
+    added = raw.iloc[200:205].assign(Model=lambda d: d['Model'].astype(str) + " EDITED")
+    repeated = raw[raw.duplicated(keep=False)].iloc[[0]]
+    write_source(store, pd.concat([edited, added, repeated]))
+    changes, base = refresh(store)
+    assert changes['added'] >= len(added) and changes['changed'] > 0 and changes['removed'] > 0
+    assert store['snapshot']['version'] == 2
+    assert_patched_matches_build(base, store['snapshot'])
+
+def test_same_mtime_rewrite_is_picked_up(store, raw):
+    write_source(store, raw)
+    core.refresh_catalogue_store(store, force=True)
+
+    # Same mtime, different content: the cache must not be served for the new bytes
+    write_source(store, raw.iloc[:1000], keep_mtime=True)
+    changes, base = refresh(store)
+    assert changes is not None
+    snap = store['snapshot']
+    assert len(snap['df']) == len(core.parse_catalogue_sheets(os.path.join(store['directory'], 'crsp.csv')))
+    assert_patched_matches_build(base, snap)
+
+def test_unchanged_rows_keep_the_version(store, raw):
+    crsp = crsp_column(raw)
+    write_source(store, raw)
+    core.refresh_catalogue_store(store, force=True)
+
+    # A row the CRSP filter drops re-tags the file without changing any catalogue row
+    write_source(store, pd.concat([raw, raw.iloc[[0]].assign(**{crsp: 0})]))
+    changes, _ = refresh(store)
+    assert changes is None
+    assert store['snapshot']['version'] == 1
+
+    # The adopted origins must still line up with the kept rows for the next real edit
+    edited = raw.copy()
+    edited.loc[50:60, crsp] = edited.loc[50:60, crsp] * 1.2
+    write_source(store, edited)
+    changes, base = refresh(store)
+    assert changes == {"added": 0, "changed": 11, "removed": 0}
+    assert store['snapshot']['version'] == 2
+    assert_patched_matches_build(base, store['snapshot'])
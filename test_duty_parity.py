@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import core
+
+# calculate_duty_frame must agree with the per-row calculate_duty_breakdown to the shilling on every
+# row of the published catalogue, for every selectable YOM plus one year past the depreciation table
+# and one future year.
+
+CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.xlsx')
+PARITY_YEARS = core.YOM_YEARS + [min(core.YOM_YEARS) - 5, max(core.YOM_YEARS) + 1]
+TOLERANCE_KES = 1.0
+
+@pytest.fixture(scope='module')
+def catalogue(tmp_path_factory):
+    if not os.path.exists(CATALOGUE): pytest.skip("data.xlsx not present")
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('cache')) # keeps the Arrow cache out of the working directory
+    try: df = core.load_catalogue([CATALOGUE])
+    finally: os.chdir(cwd)
+    assert not df.empty
+    return df
+
+@pytest.mark.parametrize('yom', PARITY_YEARS)
+def test_duty_frame_matches_breakdown(catalogue, yom):
+    frame = core.calculate_duty_frame(catalogue, yom)
+    ref = pd.DataFrame([core.calculate_duty_breakdown(row, yom) for _, row in catalogue.iterrows()], index=catalogue.index)
+
+    assert len(frame) == len(ref)
+    for c in core.DUTY_COMPONENTS:
+        diff = np.abs(frame[c].to_numpy() - ref[c].to_numpy())
+        assert diff.max() < TOLERANCE_KES, f"{c} differs by up to KES {diff.max():,.2f} at YOM {yom}"
+    assert (frame['Depreciation'].to_numpy() == ref['Depreciation'].to_numpy()).all()
+    assert (frame['Class'].to_numpy() == ref['Class'].to_numpy()).all()
+
+# Totals from the original hard-coded engine (2025 reference year, KRA July 2025 rates), one vehicle per
+# duty class and threshold edge, so an edit to the default rule set file cannot pass unnoticed:
+# (CRSP, CC, Fuel, YOM, Class, Total)
+GOLDEN = [
+    (5_000_000, 0, 'ELECTRIC', 2023, 'Electric', 1188900.5),
+    (12_000_000, 3500, 'GASOLINE', 2020, 'High Capacity (Excise 35%)', 2631706.41),
+    (8_000_000, 2800, 'DIESEL', 2018, 'High Capacity (Excise 35%)', 1403576.75),
+    (3_000_000, 2500, 'DIESEL', 2025, 'Standard (Excise 25%)', 1167665.22),
+    (2_500_000, 1500, 'PETROL', 2019, 'Small Capacity (Excise 20%)', 442624.52),
+    (4_000_000, 2000, 'HYBRID', 2026, 'Standard (Excise 25%)', 491648.51),
+    (6_000_000, 1800, 'GASOLINE', 2010, 'Standard (Excise 25%)', 860384.9),
+    (9_500_000, 3000, 'GASOLINE', 2024, 'Standard (Excise 25%)', 3697606.53),
+]
+
+@pytest.mark.parametrize('crsp, cc, fuel, yom, cls, total', GOLDEN)
+def test_default_rule_set_matches_original_constants(crsp, cc, fuel, yom, cls, total):
+    row = {'CRSP': crsp, 'CC': cc, 'Fuel': fuel}
+    ref = core.calculate_duty_breakdown(row, yom)
+    frame = core.calculate_duty_frame(pd.DataFrame([row]), yom).iloc[0]
+    for tax in (ref, frame):
+        assert tax['Class'] == cls
+        assert abs(tax['Total'] - total) < 0.01
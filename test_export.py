@@ -0,0 +1,30 @@
+import io
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+import core
+
+# Every export format must carry every row. Excel caps a worksheet at EXCEL_SHEET_ROWS, so longer exports
+# continue on further sheets, each under the header; the limit is shrunk here to keep the test small.
+
+def frame(rows):
+    return pd.DataFrame({"Make": ["TOYOTA"] * rows, "Model": [f"HARRIER {i}" for i in range(rows)], "CRSP": np.arange(rows, dtype=float)})
+
+def test_excel_rolls_over_to_new_sheets(monkeypatch):
+    monkeypatch.setattr(core, 'EXCEL_SHEET_ROWS', 4)
+    df = frame(10)
+    out = io.BytesIO()
+    core.write_export(iter([df.iloc[:7], df.iloc[7:]]), "Excel", out)
+    sheets = load_workbook(io.BytesIO(out.getvalue()), read_only=True).worksheets
+    rows = [list(s.iter_rows(values_only=True)) for s in sheets]
+    assert [len(r) for r in rows] == [4, 4, 4, 1 + 1]
+    assert all(r[0] == tuple(df.columns) for r in rows)
+    assert [r[1] for s in rows for r in s[1:]] == df['Model'].tolist()
+
+def test_excel_empty_export_keeps_header():
+    out = io.BytesIO()
+    core.write_export(iter([frame(0)]), "Excel", out)
+    sheet = load_workbook(io.BytesIO(out.getvalue()), read_only=True).active
+    assert list(sheet.iter_rows(values_only=True)) == [("Make", "Model", "CRSP")]
@@ -0,0 +1,33 @@
+import os
+
+import pandas as pd
+import pytest
+
+import core
+
+# quote_manifest resolves each dealer row by Model_Code first and make/model second. A blank code cell
+# must fall back to the name, never to whichever catalogue row happens to have no Model_Code.
+
+CATALOGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.xlsx')
+
+@pytest.fixture(scope='module')
+def catalogue(tmp_path_factory):
+    if not os.path.exists(CATALOGUE): pytest.skip("data.xlsx not present")
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('cache')) # keeps the Arrow cache out of the working directory
+    try: df = core.load_catalogue([CATALOGUE])
+    finally: os.chdir(cwd)
+    assert (df['Model_Code'].astype(object).fillna('').str.strip() == '').any()
+    return df, core.build_quote_keys(df)
+
+def test_blank_code_is_not_a_key(catalogue):
+    _, keys = catalogue
+    assert '' not in keys['code'].index
+
+@pytest.mark.parametrize('code', [None, '', '   '])
+def test_blank_code_falls_back_to_name(catalogue, code):
+    df, keys = catalogue
+    manifest = pd.DataFrame({"Make": ["TOYOTA"], "Model": ["HARRIER"], "Model_Code": [code], "YOM": [2020], "CNF_USD": [9000]})
+    quoted = core.quote_manifest(df, keys, manifest).iloc[0]
+    assert quoted['Status'] == "OK"
+    assert quoted['Matched_Name'] == "TOYOTA HARRIER"
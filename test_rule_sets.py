@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+import core
+
+# load_rule_sets puts the default regime first and, within one id, the newest version first, so a revised
+# rule-set file becomes the default without deleting the one it supersedes.
+
+def write_rule_set(directory, name, **fields):
+    with open(directory / name, 'w') as f:
+        json.dump({**core.DEFAULT_RULE_SET, **fields}, f)
+
+@pytest.mark.parametrize('versions, newest', [
+    (["2025.07", "2025.07-1"], "2025.07-1"),
+    (["2025.07-1", "2025.07-2"], "2025.07-2"),
+    (["2025.07-3", "2026.01"], "2026.01"),
+    (["2025.7", "2025.10"], "2025.10"),
+])
+def test_newest_version_of_an_id_comes_first(tmp_path, versions, newest):
+    for i, v in enumerate(versions):
+        write_rule_set(tmp_path, f"kra_{i}.json", version=v)
+        write_rule_set(tmp_path, f"scenario_{i}.json", id="scenario", version=v)
+    rule_sets = core.load_rule_sets(str(tmp_path))
+    assert [(rs['id'], rs['version']) for rs in rule_sets[:1]] == [(core.DEFAULT_RULE_SET_ID, newest)]
+    assert [rs['id'] for rs in rule_sets] == [core.DEFAULT_RULE_SET_ID] * 2 + ["scenario"] * 2
+    assert rule_sets[2]['version'] == newest